@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BusinessUnitsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'business_units'
+
+    def ready(self):
+        from business_units import signals  # noqa: F401
@@ -0,0 +1,125 @@
+import datetime
+import json
+import platform
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from django.core.management.base import BaseCommand, CommandError
+
+from eddy_school.settings import FAQ_EMBEDDING_MODEL_NAME, FAQ_MICROBATCH_WINDOW_MS, FAQ_MODEL_NAME
+from pytorch_faq.engines import ENGINES, FP32
+from pytorch_faq.index import FAQIndex, get_embedding_model
+from pytorch_faq.utils import find_best_match, get_model_and_tokenizer
+
+WORDS = (
+    "курс ціна оплата знижка розклад урок сертифікат викладач група доступ запис програма тест домашнє "
+    "завдання повернення договір рівень англійська математика course price payment discount schedule "
+    "lesson certificate teacher group access recording program test homework refund level online"
+).split()
+TEMPLATES = (
+    "Скільки коштує {0} {1}?", "Як отримати {0} після {1}?", "Коли починається {0} {1}?",
+    "Чи є {0} для {1}?", "How do I get {0} for {1}?", "What is the {0} of the {1}?",
+)
+
+
+def make_variants(size, rng):
+    return [
+        (rng.choice(TEMPLATES).format(rng.choice(WORDS), rng.choice(WORDS)) + f" {i}", f"answer {i}")
+        for i in range(size)
+    ]
+
+
+def make_paraphrase(variants, rng):
+    """A paraphrase of a random variant: one word dropped and one word replaced, so it is never an exact match."""
+    words = rng.choice(variants)[0].split()
+    words.pop(rng.randrange(len(words)))
+    words[rng.randrange(len(words))] = rng.choice(WORDS)
+    return ' '.join(words)
+
+
+class Command(BaseCommand):
+    help = "Benchmark the FAQ matching path on synthetic business units; runs offline on locally cached models."
+    # the url checks import llama_index, which wants the network
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000, 10000],
+                            help="Number of FAQ variants of each synthetic business unit.")
+        parser.add_argument('--engines', nargs='+', default=[FP32], choices=ENGINES)
+        parser.add_argument('--batch-sizes', nargs='+', type=int, default=[32])
+        parser.add_argument('--top-k', nargs='+', type=int, default=[0, 20],
+                            help="Bi-encoder pre-filter sizes, 0 scores every variant.")
+        parser.add_argument('--queries', type=int, default=20, help="Questions per configuration.")
+        parser.add_argument('--threads', type=int, default=1, help="Concurrent callers.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help="JSON results file, faq_benchmark-<time>.json by default.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        try:
+            for engine in options['engines']:
+                get_model_and_tokenizer(engine=engine, local_files_only=True)
+            if any(options['top_k']):
+                get_embedding_model(local_files_only=True)
+        except OSError as e:
+            raise CommandError(f"The models must be in the local cache, run warmup_faq_model once online: {e}")
+
+        results = []
+        for size in options['sizes']:
+            variants = make_variants(size, rng)
+            queries = [make_paraphrase(variants, rng) for _ in range(options['queries'])]
+            for top_k in options['top_k']:
+                started = time.perf_counter()
+                faq_index = FAQIndex.from_candidates(None, variants, top_k)
+                index_build_seconds = time.perf_counter() - started
+                for engine in options['engines']:
+                    for batch_size in options['batch_sizes']:
+                        result = self.run(faq_index, queries, top_k, engine, batch_size, options['threads'])
+                        result.update(variants=size, top_k=top_k, engine=engine, batch_size=batch_size,
+                                      index_build_seconds=round(index_build_seconds, 4))
+                        results.append(result)
+                        self.stdout.write(
+                            f"variants={size:<6} top_k={top_k:<4} engine={engine:<5} batch={batch_size:<4} "
+                            f"p50={result['p50_ms']:.1f}ms p95={result['p95_ms']:.1f}ms p99={result['p99_ms']:.1f}ms "
+                            f"throughput={result['throughput_qps']:.2f}q/s"
+                        )
+
+        output = options['output'] or f"faq_benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+        with open(output, 'w') as f:
+            json.dump({
+                'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'model': FAQ_MODEL_NAME,
+                'embedding_model': FAQ_EMBEDDING_MODEL_NAME,
+                'torch': torch.__version__,
+                'torch_threads': torch.get_num_threads(),
+                'python': platform.python_version(),
+                'microbatch_window_ms': FAQ_MICROBATCH_WINDOW_MS,
+                'threads': options['threads'],
+                'queries': options['queries'],
+                'seed': options['seed'],
+                'results': results,
+            }, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}"))
+
+    @staticmethod
+    def run(faq_index, queries, top_k, engine, batch_size, threads):
+        def timed_query(query):
+            started = time.perf_counter()
+            find_best_match(query, faq_index.top_k(query, top_k), batch_size=batch_size, engine=engine)
+            return time.perf_counter() - started
+
+        timed_query(queries[0])
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = np.array(list(executor.map(timed_query, queries))) * 1000
+        wall_seconds = time.perf_counter() - started
+        return {
+            'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+            'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+            'mean_ms': round(float(latencies.mean()), 3),
+            'throughput_qps': round(len(queries) / wall_seconds, 3),
+        }
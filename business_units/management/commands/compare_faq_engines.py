@@ -0,0 +1,79 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from business_units.models import BusinessUnit
+from chat_history.models import ChatHistory
+from eddy_school.settings import FAQ_PREFILTER_TOP_K
+from pytorch_faq.engines import ENGINES, FP32
+from pytorch_faq.index import get_faq_index
+from pytorch_faq.utils import find_best_match, warmup_model
+
+
+class Command(BaseCommand):
+    help = "Compare FAQ inference engines with the fp32 model on the FAQ sets of business units."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--business-unit', type=int, action='append', dest='business_units',
+                            help="Business unit id, may be repeated. All units with FAQs by default.")
+        parser.add_argument('--engines', nargs='+', default=list(ENGINES), choices=ENGINES)
+        parser.add_argument('--queries', type=int, default=50, help="Questions per business unit.")
+        parser.add_argument('--tolerance', type=float, default=0.02,
+                            help="Max allowed difference from the fp32 score.")
+
+    @staticmethod
+    def get_queries(business_unit, candidates, limit):
+        """Latest real user questions of the unit, topped up with its FAQ variants."""
+        queries = list(
+            ChatHistory.objects.filter(business_unit=business_unit, user_question__isnull=False)
+            .order_by('-created_at').values_list('user_question', flat=True)[:limit]
+        )
+        queries += [question for question, _ in candidates[:limit - len(queries)]]
+        return queries
+
+    def handle(self, *args, **options):
+        engines = [FP32] + [engine for engine in options['engines'] if engine != FP32]
+        for engine in engines:
+            warmup_model(engine=engine)
+
+        business_units = BusinessUnit.objects.filter(sqs__isnull=False).distinct()
+        if options['business_units']:
+            business_units = business_units.filter(id__in=options['business_units'])
+
+        stats = {engine: {'latency': [], 'diff': [], 'agree': 0} for engine in engines}
+        total = 0
+        for business_unit in business_units:
+            faq_index = get_faq_index(business_unit.id)
+            for query in self.get_queries(business_unit, faq_index.candidates, options['queries']):
+                candidates = faq_index.top_k(query, FAQ_PREFILTER_TOP_K)
+                total += 1
+                for engine in engines:
+                    started = time.perf_counter()
+                    answer, score = find_best_match(query, candidates, engine=engine)
+                    stats[engine]['latency'].append(time.perf_counter() - started)
+                    passed = score >= business_unit.similarity_simple_q
+                    if engine == FP32:
+                        reference_answer, reference_score, reference_passed = answer, score, passed
+                    stats[engine]['diff'].append(abs(score - reference_score))
+                    if passed == reference_passed and (not passed or answer == reference_answer):
+                        stats[engine]['agree'] += 1
+
+        if not total:
+            self.stdout.write(self.style.WARNING("No FAQ questions to compare on."))
+            return
+
+        self.stdout.write(f"{total} questions, tolerance {options['tolerance']}")
+        self.stdout.write(f"{'engine':<8}{'mean ms':>10}{'p95 ms':>10}{'max diff':>10}{'mean diff':>11}{'agree %':>9}")
+        best_engine = None
+        for engine in engines:
+            latency = np.array(stats[engine]['latency']) * 1000
+            diff = np.array(stats[engine]['diff'])
+            agree = stats[engine]['agree'] / total * 100
+            self.stdout.write(f"{engine:<8}{latency.mean():>10.2f}{np.percentile(latency, 95):>10.2f}"
+                              f"{diff.max():>10.4f}{diff.mean():>11.4f}{agree:>9.1f}")
+            within_tolerance = diff.max() <= options['tolerance'] and agree == 100
+            if within_tolerance and (best_engine is None or latency.mean() < best_engine[1]):
+                best_engine = (engine, latency.mean())
+
+        self.stdout.write(self.style.SUCCESS(f"Fastest engine within tolerance: {best_engine[0]}"))
@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from pytorch_faq.preload import MEMORY_FIELDS, read_memory_usage
+
+
+class Command(BaseCommand):
+    help = "Per-process memory (kB) of the app workers, to see how much of the model weights they share."
+
+    def add_arguments(self, parser):
+        parser.add_argument('pids', nargs='*', type=int)
+        parser.add_argument('--children-of', type=int, help="Report all child processes of this pid, "
+                                                            "e.g. the gunicorn master.")
+
+    def handle(self, *args, **options):
+        pids = list(options['pids'])
+        parent = options['children_of']
+        if parent:
+            for task in os.listdir(f'/proc/{parent}/task'):
+                with open(f'/proc/{parent}/task/{task}/children') as f:
+                    pids += [int(pid) for pid in f.read().split()]
+        if not pids:
+            pids = [os.getpid()]
+
+        self.stdout.write(f"{'pid':>8}" + ''.join(f"{field:>15}" for field in MEMORY_FIELDS))
+        totals = dict.fromkeys(MEMORY_FIELDS, 0)
+        for pid in pids:
+            usage = read_memory_usage(pid)
+            for field in MEMORY_FIELDS:
+                totals[field] += usage.get(field, 0)
+            self.stdout.write(f"{pid:>8}" + ''.join(f"{usage.get(field, 0):>15}" for field in MEMORY_FIELDS))
+        self.stdout.write(f"{'total':>8}" + ''.join(f"{totals[field]:>15}" for field in MEMORY_FIELDS))
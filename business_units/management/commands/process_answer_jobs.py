@@ -0,0 +1,50 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from eddy_school.settings import ANSWER_JOB_CONCURRENCY
+
+
+class Command(BaseCommand):
+    help = "Answer the queued webhooks (ANSWERING_QUEUE). Several processes can run side by side."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=ANSWER_JOB_CONCURRENCY,
+                            help="Jobs answered at the same time by this process.")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        from restapi.v1.answering_gpt.jobs import claim_answer_job
+
+        # a job is claimed only when a thread is free to run it, so the other processes can take the rest
+        slots = threading.Semaphore(options['concurrency'])
+        with ThreadPoolExecutor(options['concurrency'], thread_name_prefix='answer-job') as executor:
+            while True:
+                slots.acquire()
+                close_old_connections()
+                job = claim_answer_job()
+                if job is None:
+                    slots.release()
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                executor.submit(self.run, job, slots)
+
+    def run(self, job, slots):
+        from restapi.v1.answering_gpt.jobs import run_answer_job
+
+        close_old_connections()
+        try:
+            run_answer_job(job)
+            self.stdout.write(f"Job {job.id} done")
+        except Exception as e:
+            self.stderr.write(f"Job {job.id} failed (attempt {job.attempts}): {e}")
+        finally:
+            close_old_connections()
+            slots.release()
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from business_units.models import BusinessUnit, Document
+from eddy_school.settings import DOCUMENTS_SYNC_INTERVAL
+from utils import (
+    sync_documents, get_documents_folder, get_index_name, get_google_creds_path,
+    get_service_context, use_openai_key
+)
+
+
+class Command(BaseCommand):
+    help = "Poll the Google Docs of every active LlamaIndex business unit and refresh snapshots and indexes " \
+           "when they change. Run it next to the web workers with DOCUMENTS_BACKGROUND_SYNC on."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=DOCUMENTS_SYNC_INTERVAL, help="Seconds between polls.")
+        parser.add_argument('--once', action='store_true', help="Sync every business unit once and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            close_old_connections()
+            self.sync_all()
+            if options['once']:
+                return
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def sync_all(self):
+        business_units = BusinessUnit.objects.filter(is_active=True, script_mode=BusinessUnit.LLM_MODE)
+        for business_unit in business_units:
+            document_ids = list(
+                Document.objects.filter(business_unit=business_unit).values_list('document_id', flat=True)
+            )
+            if not document_ids or not business_unit.google_creds:
+                continue
+            try:
+                use_openai_key(business_unit.gpt_api_key)
+                synced = sync_documents(
+                    business_unit, document_ids, get_documents_folder(business_unit), get_index_name(business_unit),
+                    get_google_creds_path(business_unit), get_service_context(business_unit)
+                )
+            except Exception as e:
+                self.stderr.write(f"{business_unit}: sync failed: {e}")
+                continue
+            if synced is not None:
+                self.stdout.write(f"{business_unit}: index rebuilt")
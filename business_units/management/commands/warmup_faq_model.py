@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from eddy_school.settings import FAQ_ENGINE, FAQ_MODEL_NAME
+from pytorch_faq.engines import ENGINES
+from pytorch_faq.utils import warmup_model
+
+
+class Command(BaseCommand):
+    help = "Download (if needed), load and warm up the FAQ similarity model."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=FAQ_MODEL_NAME, help="Model name or local path.")
+        parser.add_argument('--engine', default=FAQ_ENGINE, choices=ENGINES)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        warmup_model(options['model'], options['engine'])
+        self.stdout.write(self.style.SUCCESS(
+            f"FAQ model {options['model']} ({options['engine']}) is ready in {time.perf_counter() - started:.2f}s"
+        ))
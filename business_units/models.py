@@ -122,6 +122,7 @@ class SimpleQuestions(models.Model):
     business_unit = models.ForeignKey(BusinessUnit, related_name='sqs', on_delete=models.CASCADE)
     question = models.TextField()
     answer = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.question
@@ -0,0 +1,24 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from business_units.models import BusinessUnit, SimpleQuestions
+from pytorch_faq.cache import invalidate_business_unit
+
+
+@receiver([post_save, post_delete], sender=SimpleQuestions)
+def invalidate_faq_matches(sender, instance, **kwargs):
+    invalidate_business_unit(instance.business_unit_id)
+
+
+@receiver(post_init, sender=BusinessUnit)
+def remember_similarity_simple_q(sender, instance, **kwargs):
+    # __dict__ lookup so that deferred fields are not loaded here
+    instance._saved_similarity_simple_q = instance.__dict__.get('similarity_simple_q')
+
+
+@receiver(post_save, sender=BusinessUnit)
+def invalidate_faq_matches_on_threshold_change(sender, instance, created, **kwargs):
+    similarity_simple_q = instance.__dict__.get('similarity_simple_q')
+    if not created and similarity_simple_q != instance._saved_similarity_simple_q:
+        invalidate_business_unit(instance.id)
+    instance._saved_similarity_simple_q = similarity_simple_q
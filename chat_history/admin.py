@@ -3,7 +3,7 @@ from import_export.admin import ExportMixin
 from rangefilter.filters import DateRangeFilterBuilder
 
 from chat_history.forms import ChatHistoryForm
-from chat_history.models import ChatHistory
+from chat_history.models import AnswerJob, ChatHistory
 from chat_history.resources import ChatHistoryResource
 
 
@@ -24,3 +24,21 @@ class ChatHistoryAdmin(ExportMixin, admin.ModelAdmin):
         ("created_at", DateRangeFilterBuilder()),
         "business_unit",
     )
+
+
+@admin.register(AnswerJob)
+class AnswerJobAdmin(admin.ModelAdmin):
+    list_display = (
+        "id",
+        "business_unit",
+        "status",
+        "attempts",
+        "locked_until",
+        "delivered_at",
+        "created_at",
+        "updated_at"
+    )
+    list_filter = (
+        "status",
+        "business_unit",
+    )
@@ -17,3 +17,39 @@ class ChatHistory(models.Model):
 
     def __str__(self):
         return f"{self.business_unit} - {self.username} - {self.created_at}"
+
+
+class AnswerJob(models.Model):
+    """An accepted answering webhook, processed by the process_answer_jobs workers."""
+    PENDING = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    STATUS = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    business_unit = models.ForeignKey(
+        BusinessUnit, on_delete=models.CASCADE, verbose_name='Business Unit'
+    )
+    payload = models.JSONField(verbose_name="Request data")
+    status = models.PositiveIntegerField(choices=STATUS, default=PENDING, verbose_name="Status")
+    attempts = models.PositiveIntegerField(default=0, verbose_name="Attempts")
+    # a running job whose lease ran out belongs to a crashed worker and is picked up again
+    locked_until = models.DateTimeField(blank=True, null=True, verbose_name="Locked until")
+    # set once the answer was sent, a retry after that only saves the chat history
+    delivered_at = models.DateTimeField(blank=True, null=True, verbose_name="Delivered at")
+    answer = models.TextField(blank=True, verbose_name="Answer")
+    error = models.TextField(blank=True, verbose_name="Error")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'locked_until'])]
+
+    def __str__(self):
+        return f"{self.business_unit} - {self.get_status_display()} - {self.created_at}"
@@ -0,0 +1,48 @@
+import os
+import threading
+from collections import OrderedDict
+
+from eddy_school.settings import INDEX_CACHE_MAX_BYTES
+
+
+def get_directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class IndexCache:
+    """LRU of loaded indexes, one version per key, evicted by an approximate byte budget.
+
+    The size of an index is taken as the size of its persisted files, which grows with the in-memory size.
+    """
+
+    def __init__(self, max_bytes=INDEX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, index, size):
+        with self.lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (version, index, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+
+index_cache = IndexCache()
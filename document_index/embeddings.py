@@ -0,0 +1,105 @@
+import hashlib
+import sqlite3
+import threading
+from typing import List
+
+import numpy as np
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding
+
+from eddy_school.settings import EMBEDDING_CACHE_PATH
+
+_connections = threading.local()
+
+
+def get_connection(path=EMBEDDING_CACHE_PATH):
+    """One connection per thread; WAL lets the web workers read while the sync worker writes."""
+    connection = getattr(_connections, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)')
+        _connections.connection = connection
+    return connection
+
+
+def get_embedding_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+
+def read_embeddings(keys):
+    found = {}
+    connection = get_connection()
+    # sqlite allows 999 parameters per query
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        rows = connection.execute(
+            f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+        )
+        found.update((key, np.frombuffer(embedding, dtype=np.float32).tolist()) for key, embedding in rows)
+    return found
+
+
+def write_embeddings(items):
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)',
+            [(key, np.asarray(embedding, dtype=np.float32).tobytes()) for key, embedding in items],
+        )
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Text embeddings of another model, stored by hash of model name and text.
+
+    Identical chunks are embedded once, whatever business unit or rebuild they come from. Queries are not cached.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding) -> None:
+        self._embed_model = embed_model
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed_model._get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return await self._embed_model._aget_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._lookup(texts)
+        if missing:
+            self._store(found, missing, self._embed_model._get_text_embeddings(missing))
+        return [found[key] for key in keys]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._lookup(texts)
+        if missing:
+            self._store(found, missing, await self._embed_model._aget_text_embeddings(missing))
+        return [found[key] for key in keys]
+
+    def _lookup(self, texts):
+        keys = [get_embedding_key(self.model_name, text) for text in texts]
+        found = read_embeddings(list(set(keys)))
+        missing = list({key: text for key, text in zip(keys, texts) if key not in found}.values())
+        return keys, found, missing
+
+    def _store(self, found, missing, embeddings):
+        new = {get_embedding_key(self.model_name, text): embedding for text, embedding in zip(missing, embeddings)}
+        write_embeddings(new.items())
+        found.update(new)
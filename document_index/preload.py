@@ -0,0 +1,14 @@
+import os
+
+
+def preload_document_indexes():
+    """Load the saved indexes of the active LlamaIndex units into the index cache."""
+    # imported here: gunicorn calls the hooks before Django is set up when the app is not preloaded
+    from business_units.models import BusinessUnit
+    from utils import get_index, get_index_name, get_service_context, use_openai_key
+
+    for business_unit in BusinessUnit.objects.filter(is_active=True, script_mode=BusinessUnit.LLM_MODE):
+        index_name = get_index_name(business_unit)
+        if os.path.exists(index_name):
+            use_openai_key(business_unit.gpt_api_key)
+            get_index(index_name, business_unit.gpt_api_key, get_service_context(business_unit))
@@ -0,0 +1,67 @@
+import threading
+
+import numpy as np
+
+from eddy_school.settings import RESPONSE_CACHE_SIZE, RESPONSE_CACHE_THRESHOLD
+
+
+class ResponseCache:
+    """Responses of one business unit with the unit-normalized embeddings of their queries and the ids of the nodes
+    they were generated from, oldest replaced first."""
+
+    def __init__(self, version):
+        self.version = version
+        self.embeddings = None
+        self.responses = []
+        self.next_row = 0
+
+    def find(self, query_embedding, threshold, source_ids):
+        if not self.responses:
+            return None
+        similarities = self.embeddings[:len(self.responses)] @ query_embedding
+        rows = np.flatnonzero(similarities >= threshold)
+        for row in rows[np.argsort(-similarities[rows])]:
+            response, response_source_ids = self.responses[row]
+            if response_source_ids == source_ids:
+                return response
+        return None
+
+    def add(self, query_embedding, source_ids, response):
+        if self.embeddings is None:
+            self.embeddings = np.empty((RESPONSE_CACHE_SIZE, len(query_embedding)), dtype=np.float32)
+        self.embeddings[self.next_row] = query_embedding
+        if self.next_row < len(self.responses):
+            self.responses[self.next_row] = (response, source_ids)
+        else:
+            self.responses.append((response, source_ids))
+        self.next_row = (self.next_row + 1) % RESPONSE_CACHE_SIZE
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def normalize_embedding(embedding):
+    embedding = np.asarray(embedding, dtype=np.float32)
+    return embedding / (np.linalg.norm(embedding) or 1)
+
+
+def get_cached_response(bu_id, version, query_embedding, source_ids, threshold=RESPONSE_CACHE_THRESHOLD):
+    """Response of an earlier query at least threshold cosine-similar to this one that retrieved the same nodes,
+    None when there is none."""
+    with _caches_lock:
+        cache = _caches.get(bu_id)
+        if cache is None or cache.version != version:
+            return None
+        return cache.find(normalize_embedding(query_embedding), threshold, source_ids)
+
+
+def cache_response(bu_id, version, query_embedding, source_ids, response):
+    if not RESPONSE_CACHE_SIZE:
+        return
+    with _caches_lock:
+        cache = _caches.get(bu_id)
+        # a new index version or unit settings make every cached response stale
+        if cache is None or cache.version != version:
+            cache = _caches[bu_id] = ResponseCache(version)
+        cache.add(normalize_embedding(query_embedding), source_ids, response)
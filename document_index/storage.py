@@ -0,0 +1,48 @@
+import os
+import shutil
+import time
+
+from filelock import FileLock
+
+KEPT_INDEX_VERSIONS = 2
+
+
+def get_versions_folder(index_name):
+    return f"{index_name}.versions"
+
+
+def get_index_path(index_name):
+    """Directory of the current version of the index, None when there is no saved index."""
+    index_path = os.path.realpath(index_name)
+    return index_path if os.path.isdir(index_path) else None
+
+
+def get_index_lock(index_name):
+    return FileLock(f"{index_name}.lock")
+
+
+def new_index_version(index_name, base_path=None):
+    """A new version directory, a copy of base_path when given so that version can be updated incrementally."""
+    index_path = os.path.join(get_versions_folder(index_name), str(time.time_ns()))
+    if base_path:
+        shutil.copytree(base_path, index_path)
+    else:
+        os.makedirs(index_path)
+    return index_path
+
+
+def publish_index_version(index_name, index_path):
+    """Point index_name at index_path with an atomic symlink swap. Must be called under the index lock."""
+    versions_folder = get_versions_folder(index_name)
+    if os.path.isdir(index_name) and not os.path.islink(index_name):
+        # an index saved before versioning, it becomes an old version
+        os.rename(index_name, os.path.join(versions_folder, '0'))
+    link = f"{index_name}.{os.getpid()}.tmp"
+    os.symlink(os.path.relpath(index_path, os.path.dirname(os.path.abspath(index_name))), link)
+    os.replace(link, index_name)
+
+    # the previous version is kept for requests still loading it, older ones and failed builds are removed
+    versions = sorted(os.listdir(versions_folder), key=int)
+    for version in versions[:-KEPT_INDEX_VERSIONS]:
+        if os.path.join(versions_folder, version) != index_path:
+            shutil.rmtree(os.path.join(versions_folder, version), ignore_errors=True)
@@ -0,0 +1,151 @@
+import json
+import os
+from typing import Any, List, Optional
+
+import fsspec
+import numpy as np
+from llama_index import StorageContext
+from llama_index.schema import BaseNode
+from llama_index.vector_stores import SimpleVectorStore
+from llama_index.vector_stores.types import VectorStore, VectorStoreQuery, VectorStoreQueryMode, \
+    VectorStoreQueryResult
+
+VECTORS_FNAME = 'vectors.npy'
+VECTORS_IDS_FNAME = 'vectors.json'
+
+
+class NumpyVectorStore(VectorStore):
+    """Unit-normalized float32 embeddings in one matrix, memory-mapped when loaded from disk.
+
+    Workers that load the same index version share its pages through the page cache, and top-k is a single
+    matrix-vector product. Rows follow node_ids, ref_doc_ids tell which rows to delete with a document. Only the
+    default query mode without metadata filters is supported, which is all the query engine uses.
+    """
+
+    stores_text: bool = False
+
+    def __init__(self, embeddings=None, node_ids=None, ref_doc_ids=None) -> None:
+        self._embeddings = embeddings
+        self._pending = []
+        self._node_ids = node_ids or []
+        self._ref_doc_ids = ref_doc_ids or []
+        self._positions = {node_id: position for position, node_id in enumerate(self._node_ids)}
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "NumpyVectorStore":
+        """Load the store, converting the json vector store of an index saved before this one was used."""
+        if not os.path.exists(os.path.join(persist_dir, VECTORS_FNAME)):
+            return cls.from_simple_vector_store(SimpleVectorStore.from_persist_dir(persist_dir, namespace='default'))
+        with open(os.path.join(persist_dir, VECTORS_IDS_FNAME)) as f:
+            ids = json.load(f)
+        embeddings = np.load(os.path.join(persist_dir, VECTORS_FNAME), mmap_mode='r')
+        return cls(embeddings, ids['node_ids'], ids['ref_doc_ids'])
+
+    @classmethod
+    def from_simple_vector_store(cls, simple_vector_store: SimpleVectorStore) -> "NumpyVectorStore":
+        data = simple_vector_store._data
+        vector_store = cls()
+        for node_id, embedding in data.embedding_dict.items():
+            vector_store._append(node_id, data.text_id_to_ref_doc_id.get(node_id, "None"), embedding)
+        return vector_store
+
+    @property
+    def client(self) -> None:
+        return None
+
+    def _append(self, node_id, ref_doc_id, embedding):
+        if node_id in self._positions:
+            raise ValueError(f"Node {node_id} is already in the vector store.")
+        self._positions[node_id] = len(self._node_ids)
+        self._node_ids.append(node_id)
+        self._ref_doc_ids.append(ref_doc_id)
+        self._pending.append(embedding)
+
+    def _matrix(self):
+        """All embeddings as one matrix, stacking the rows added since the last call."""
+        if self._pending:
+            pending = np.asarray(self._pending, dtype=np.float32)
+            norms = np.linalg.norm(pending, axis=1, keepdims=True)
+            pending /= np.where(norms == 0, 1, norms)
+            self._embeddings = pending if self._embeddings is None or not len(self._embeddings) else \
+                np.concatenate([self._embeddings, pending])
+            self._pending = []
+        return self._embeddings
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        for node in nodes:
+            self._append(node.node_id, node.ref_doc_id or "None", node.get_embedding())
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        keep = [position for position, ref_doc_id_ in enumerate(self._ref_doc_ids) if ref_doc_id_ != ref_doc_id]
+        if len(keep) == len(self._node_ids):
+            return
+        embeddings = self._matrix()
+        self._embeddings = np.array(embeddings[keep]) if embeddings is not None else None
+        self._node_ids = [self._node_ids[position] for position in keep]
+        self._ref_doc_ids = [self._ref_doc_ids[position] for position in keep]
+        self._positions = {node_id: position for position, node_id in enumerate(self._node_ids)}
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.mode != VectorStoreQueryMode.DEFAULT or query.filters is not None:
+            raise ValueError("NumpyVectorStore supports only the default query mode without metadata filters.")
+        embeddings = self._matrix()
+        if embeddings is None or not len(embeddings):
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        positions = None
+        if query.node_ids is not None:
+            positions = [self._positions[node_id] for node_id in query.node_ids if node_id in self._positions]
+            # the retriever passes every node of the index, no need to copy the rows
+            if len(positions) == len(self._node_ids):
+                positions = None
+        if query.doc_ids is not None:
+            doc_ids = set(query.doc_ids)
+            positions = [
+                position for position in (range(len(self._node_ids)) if positions is None else positions)
+                if self._ref_doc_ids[position] in doc_ids
+            ]
+        if positions is not None:
+            positions = np.asarray(positions, dtype=np.int64)
+            if not len(positions):
+                return VectorStoreQueryResult(similarities=[], ids=[])
+            embeddings = embeddings[positions]
+
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        # rows are unit vectors, so this is the cosine similarity
+        similarities = embeddings @ (query_embedding / (np.linalg.norm(query_embedding) or 1))
+        k = min(query.similarity_top_k, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        rows = top if positions is None else positions[top]
+        return VectorStoreQueryResult(
+            similarities=similarities[top].tolist(),
+            ids=[self._node_ids[row] for row in rows],
+        )
+
+    def persist(self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None) -> None:
+        """Write vectors.npy and vectors.json next to persist_path, the json vector store path of llama_index."""
+        persist_dir = os.path.dirname(persist_path)
+        os.makedirs(persist_dir, exist_ok=True)
+        embeddings = self._matrix()
+        if embeddings is None:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        # written aside and renamed, the store itself may be a memory map of the file it replaces
+        vectors_path = os.path.join(persist_dir, VECTORS_FNAME)
+        with open(f"{vectors_path}.tmp", 'wb') as f:
+            np.save(f, embeddings)
+        os.replace(f"{vectors_path}.tmp", vectors_path)
+        with open(os.path.join(persist_dir, VECTORS_IDS_FNAME), 'w') as f:
+            json.dump({'node_ids': self._node_ids, 'ref_doc_ids': self._ref_doc_ids}, f)
+        # the json store a converted index was loaded from is stale now
+        if os.path.exists(persist_path):
+            os.remove(persist_path)
+
+
+def get_storage_context(persist_dir=None):
+    """Storage context of an index with a NumpyVectorStore, a new empty one without persist_dir."""
+    if persist_dir is None:
+        return StorageContext.from_defaults(vector_store=NumpyVectorStore())
+    return StorageContext.from_defaults(persist_dir=persist_dir,
+                                        vector_store=NumpyVectorStore.from_persist_dir(persist_dir))
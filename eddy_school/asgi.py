@@ -14,3 +14,7 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'eddy_school.settings')
 
 application = get_asgi_application()
+
+from pytorch_faq.utils import warmup_on_startup  # noqa: E402
+
+warmup_on_startup()
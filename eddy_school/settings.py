@@ -136,3 +136,83 @@ REST_FRAMEWORK = {'DEFAULT_SCHEMA_CLASS': 'rest_framework.schemas.coreapi.AutoSc
 SEND_PULSE_URL = os.getenv('SEND_PULSE_URL', 'https://api.sendpulse.com')
 
 SMART_SENDER_URL = os.getenv('SMART_SENDER_URL', 'https://api.smartsender.com')
+
+FAQ_MODEL_NAME = os.getenv('FAQ_MODEL_NAME', 'cross-encoder/nli-distilroberta-base')
+
+FAQ_MODEL_WARMUP = os.getenv("FAQ_MODEL_WARMUP", "true").lower() in {"true", "1", "yes"}
+
+FAQ_BATCH_SIZE = int(os.getenv('FAQ_BATCH_SIZE', 32))
+
+FAQ_EMBEDDING_MODEL_NAME = os.getenv('FAQ_EMBEDDING_MODEL_NAME',
+                                     'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+
+FAQ_PREFILTER_TOP_K = int(os.getenv('FAQ_PREFILTER_TOP_K', 20))
+
+FAQ_ENGINE = os.getenv('FAQ_ENGINE', 'fp32')
+
+FAQ_ONNX_DIR = os.getenv('FAQ_ONNX_DIR', os.path.join(BASE_DIR, 'onnx_models'))
+
+FAQ_CACHE_SIZE = int(os.getenv('FAQ_CACHE_SIZE', 10000))
+
+FAQ_CACHE_TTL = int(os.getenv('FAQ_CACHE_TTL', 3600))
+
+FAQ_MICROBATCH_WINDOW_MS = float(os.getenv('FAQ_MICROBATCH_WINDOW_MS', 0))
+
+FAQ_MICROBATCH_MAX_PAIRS = int(os.getenv('FAQ_MICROBATCH_MAX_PAIRS', 64))
+
+FAQ_SHARE_MEMORY = os.getenv("FAQ_SHARE_MEMORY", "false").lower() in {"true", "1", "yes"}
+
+FAQ_TORCH_THREADS = int(os.getenv('FAQ_TORCH_THREADS', 0))
+
+DOCUMENTS_BACKGROUND_SYNC = os.getenv("DOCUMENTS_BACKGROUND_SYNC", "false").lower() in {"true", "1", "yes"}
+
+DOCUMENTS_SYNC_INTERVAL = int(os.getenv('DOCUMENTS_SYNC_INTERVAL', 60))
+
+INDEX_CACHE_MAX_BYTES = int(os.getenv('INDEX_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# empty to disable the embedding cache
+EMBEDDING_CACHE_PATH = os.getenv('EMBEDDING_CACHE_PATH', os.path.join(BASE_DIR, 'embedding_cache.sqlite3'))
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1000))
+
+RESPONSE_CACHE_THRESHOLD = float(os.getenv('RESPONSE_CACHE_THRESHOLD', 0.98))
+
+LLM_STREAMING = os.getenv("LLM_STREAMING", "false").lower() in {"true", "1", "yes"}
+
+LLM_STREAM_MIN_PART_LENGTH = int(os.getenv('LLM_STREAM_MIN_PART_LENGTH', 200))
+
+LLM_STREAM_MIN_FIRST_PART_LENGTH = int(os.getenv('LLM_STREAM_MIN_FIRST_PART_LENGTH', 40))
+
+# async answering view: threads for the blocking ORM and LLM steps, and the shared outbound HTTP client
+ASYNC_ORM_WORKERS = int(os.getenv('ASYNC_ORM_WORKERS', 16))
+
+ASYNC_LLM_WORKERS = int(os.getenv('ASYNC_LLM_WORKERS', 32))
+
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 30))
+
+# keep-alive sessions of the sync code: connections kept per provider host, and retries of failed connects
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 20))
+
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 3))
+
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.5))
+
+# SendPulse access tokens are used for SEND_PULSE_TOKEN_TTL seconds and renewed in the background
+# SEND_PULSE_TOKEN_REFRESH_AHEAD seconds before that
+SEND_PULSE_TOKEN_TTL = int(os.getenv('SEND_PULSE_TOKEN_TTL', 50 * 60))
+
+SEND_PULSE_TOKEN_REFRESH_AHEAD = int(os.getenv('SEND_PULSE_TOKEN_REFRESH_AHEAD', 10 * 60))
+
+# answer parts packed into one viber or live chat request, telegram takes one text per request
+SEND_PULSE_MAX_MESSAGES_PER_REQUEST = int(os.getenv('SEND_PULSE_MAX_MESSAGES_PER_REQUEST', 10))
+
+# answering webhooks get 202 at once and the answers are sent by the process_answer_jobs workers
+ANSWERING_QUEUE = os.getenv("ANSWERING_QUEUE", "false").lower() in {"true", "1", "yes"}
+
+ANSWER_JOB_CONCURRENCY = int(os.getenv('ANSWER_JOB_CONCURRENCY', 4))
+
+ANSWER_JOB_LEASE = int(os.getenv('ANSWER_JOB_LEASE', 300))
+
+ANSWER_JOB_MAX_ATTEMPTS = int(os.getenv('ANSWER_JOB_MAX_ATTEMPTS', 3))
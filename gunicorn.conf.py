@@ -0,0 +1,27 @@
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+wsgi_app = os.getenv('GUNICORN_APP', 'eddy_school.wsgi:application')
+
+# Load the app, and with it the FAQ models, in the master so that the forked workers share the weights
+# copy-on-write instead of each loading its own copy.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() in {"true", "1", "yes"}
+
+
+def when_ready(server):
+    if preload_app:
+        from pytorch_faq.preload import prepare_fork
+        prepare_fork()
+
+
+def post_fork(server, worker):
+    from pytorch_faq.preload import after_fork
+    after_fork()
+
+
+def post_worker_init(worker):
+    from pytorch_faq.preload import read_memory_usage
+    worker.log.info("Worker %s memory, kB: %s", worker.pid, read_memory_usage())
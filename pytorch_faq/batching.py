@@ -0,0 +1,74 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from eddy_school.settings import FAQ_MICROBATCH_MAX_PAIRS, FAQ_MICROBATCH_WINDOW_MS
+
+
+class MicroBatcher:
+    """Collects (question, sample) pairs from concurrent callers and scores them in one batch.
+
+    The first request opens a window of window_ms milliseconds (or until max_pairs pairs are queued), then all
+    queued pairs go through score_pairs(u_questions, sample_questions) on the worker thread and every caller gets
+    its own slice of the scores back.
+    """
+
+    def __init__(self, score_pairs, window_ms=FAQ_MICROBATCH_WINDOW_MS, max_pairs=FAQ_MICROBATCH_MAX_PAIRS):
+        self.score_pairs = score_pairs
+        self.window = window_ms / 1000
+        self.max_pairs = max_pairs
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def _ensure_started(self):
+        # threads do not survive fork, so a forked worker starts its own
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.requests = queue.Queue()
+                threading.Thread(target=self._run, name='faq-microbatcher', daemon=True).start()
+                self.pid = os.getpid()
+
+    def submit(self, u_question, sample_questions):
+        """Blocking: the similarities of the question to every sample, in order."""
+        if not sample_questions:
+            return []
+        self._ensure_started()
+        future = Future()
+        self.requests.put((u_question, sample_questions, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        pairs = len(batch[0][1])
+        deadline = time.monotonic() + self.window
+        while pairs < self.max_pairs:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+            pairs += len(batch[-1][1])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                scores = self.score_pairs(
+                    [u_question for u_question, samples, _ in batch for _ in samples],
+                    [sample for _, samples, _ in batch for sample in samples],
+                )
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for _, samples, future in batch:
+                future.set_result(scores[offset:offset + len(samples)])
+                offset += len(samples)
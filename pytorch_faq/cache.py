@@ -0,0 +1,27 @@
+import threading
+
+from cachetools import TTLCache
+
+from eddy_school.settings import FAQ_CACHE_SIZE, FAQ_CACHE_TTL
+
+_matches = TTLCache(maxsize=FAQ_CACHE_SIZE or 1, ttl=FAQ_CACHE_TTL)
+_matches_lock = threading.Lock()
+
+
+def get_cached_match(bu_id, version, question_key):
+    """(best answer, best score) of an already scored question, None when it is not cached."""
+    with _matches_lock:
+        return _matches.get((bu_id, version, question_key))
+
+
+def cache_match(bu_id, version, question_key, answer, score):
+    if not FAQ_CACHE_SIZE:
+        return
+    with _matches_lock:
+        _matches[(bu_id, version, question_key)] = (answer, score)
+
+
+def invalidate_business_unit(bu_id):
+    with _matches_lock:
+        for key in [key for key in _matches.keys() if key[0] == bu_id]:
+            _matches.pop(key, None)
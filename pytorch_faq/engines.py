@@ -0,0 +1,67 @@
+import inspect
+import os
+from types import SimpleNamespace
+
+import torch
+
+from eddy_school.settings import FAQ_ONNX_DIR
+
+FP32 = 'fp32'
+INT8 = 'int8'
+ONNX = 'onnx'
+
+ENGINES = (FP32, INT8, ONNX)
+
+
+def quantize_model(model_p):
+    """Dynamic int8 quantization of the Linear layers, the bulk of the transformer's CPU time."""
+    return torch.quantization.quantize_dynamic(model_p, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxModel:
+    """onnxruntime session that can be called like the torch model: model_p(**inputs).logits."""
+
+    def __init__(self, onnx_path):
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError("The onnx FAQ engine needs the onnx and onnxruntime packages installed.") from e
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def __call__(self, **inputs):
+        logits = self.session.run(['logits'], {name: inputs[name].numpy() for name in self.input_names})[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+
+def get_onnx_path(model_name):
+    return os.path.join(FAQ_ONNX_DIR, model_name.replace('/', '--') + '.onnx')
+
+
+def export_onnx(model_p, tokenizer_p, onnx_path):
+    os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+    inputs = tokenizer_p(['warmup'], ['warmup'], return_tensors="pt")
+    # graph inputs follow the order of forward()'s parameters, not the tokenizer's keys
+    input_names = [name for name in inspect.signature(model_p.forward).parameters if name in inputs]
+    tmp_path = f"{onnx_path}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        model_p, ({name: inputs[name] for name in input_names},), tmp_path,
+        input_names=input_names, output_names=['logits'],
+        dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names}, 'logits': {0: 'batch'}},
+        opset_version=14,
+    )
+    os.replace(tmp_path, onnx_path)
+
+
+def build_engine(engine, model_p, tokenizer_p, model_name):
+    """Wrap the fp32 model into the requested inference engine."""
+    if engine == FP32:
+        return model_p
+    if engine == INT8:
+        return quantize_model(model_p)
+    if engine == ONNX:
+        onnx_path = get_onnx_path(model_name)
+        if not os.path.exists(onnx_path):
+            export_onnx(model_p, tokenizer_p, onnx_path)
+        return OnnxModel(onnx_path)
+    raise ValueError(f"Unknown FAQ engine {engine!r}, expected one of {', '.join(ENGINES)}")
@@ -0,0 +1,118 @@
+import re
+import threading
+
+import numpy as np
+import torch
+from django.db.models import Count, Max
+from transformers import AutoModel, AutoTokenizer
+
+from business_units.models import SimpleQuestions
+from eddy_school.settings import FAQ_BATCH_SIZE, FAQ_EMBEDDING_MODEL_NAME, FAQ_PREFILTER_TOP_K
+from pytorch_faq.registry import get_loaded
+
+NON_WORD_RE = re.compile(r'[^\w\s]|_')
+
+_faq_indexes = {}
+# one lock per business unit, so a large FAQ being rebuilt only holds up the lookups of its own unit
+_faq_index_locks = {}
+_faq_index_locks_lock = threading.Lock()
+
+
+def load_embedding_model(model_name=FAQ_EMBEDDING_MODEL_NAME, local_files_only=False):
+    tokenizer_e = AutoTokenizer.from_pretrained(model_name, local_files_only=local_files_only)
+    model_e = AutoModel.from_pretrained(model_name, local_files_only=local_files_only)
+    model_e.eval()
+    return model_e, tokenizer_e
+
+
+def get_embedding_model(model_name=FAQ_EMBEDDING_MODEL_NAME, local_files_only=False):
+    return get_loaded(('bi-encoder', model_name), lambda: load_embedding_model(model_name, local_files_only))
+
+
+def get_embeddings(texts, model_e, tokenizer_e, batch_size=FAQ_BATCH_SIZE):
+    """Mean-pooled, L2-normalized sentence embeddings as a float32 (len(texts), dim) matrix."""
+    chunks = [np.zeros((0, model_e.config.hidden_size), dtype=np.float32)]
+    for start in range(0, len(texts), batch_size):
+        inputs = tokenizer_e(texts[start:start + batch_size], return_tensors="pt", padding=True, truncation=True)
+        with torch.no_grad():
+            hidden = model_e(**inputs).last_hidden_state
+        mask = inputs['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+        pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        chunks.append(torch.nn.functional.normalize(pooled, dim=1).numpy().astype(np.float32))
+    return np.concatenate(chunks)
+
+
+def normalize_question(text):
+    """Case, punctuation and whitespace insensitive key of a question."""
+    return ' '.join(NON_WORD_RE.sub(' ', text.casefold()).split())
+
+
+class FAQIndex:
+    """(question variant, answer) pairs of one business unit with their sentence embeddings."""
+
+    def __init__(self, version, candidates, embeddings=None):
+        self.version = version
+        self.candidates = candidates
+        self.embeddings = embeddings
+        self.exact_answers = {}
+        for question, answer in candidates:
+            key = normalize_question(question)
+            if key:
+                self.exact_answers.setdefault(key, answer)
+
+    @classmethod
+    def build(cls, bu_id, version, top_k=FAQ_PREFILTER_TOP_K):
+        candidates = [
+            (question, faq.answer)
+            for faq in SimpleQuestions.objects.filter(business_unit_id=bu_id)
+            for question in faq.get_questions()
+        ]
+        return cls.from_candidates(version, candidates, top_k)
+
+    @classmethod
+    def from_candidates(cls, version, candidates, top_k=FAQ_PREFILTER_TOP_K):
+        embeddings = None
+        if top_k and len(candidates) > top_k:
+            model_e, tokenizer_e = get_embedding_model()
+            embeddings = get_embeddings([question for question, _ in candidates], model_e, tokenizer_e)
+        return cls(version, candidates, embeddings)
+
+    def exact_answer(self, question):
+        return self.exact_answers.get(normalize_question(question))
+
+    def top_k(self, question, k):
+        """The k candidates closest to the question, best first; all of them when there is nothing to filter."""
+        if self.embeddings is None or not k or len(self.candidates) <= k:
+            return self.candidates
+        model_e, tokenizer_e = get_embedding_model()
+        scores = self.embeddings @ get_embeddings([question], model_e, tokenizer_e)[0]
+        best = np.argpartition(-scores, k - 1)[:k]
+        return [self.candidates[i] for i in best[np.argsort(-scores[best])]]
+
+
+def get_faq_version(bu_id):
+    """Changes on every insert, edit or delete of the unit's SimpleQuestions rows."""
+    version = SimpleQuestions.objects.filter(business_unit_id=bu_id).aggregate(
+        count=Count('id'), updated_at=Max('updated_at')
+    )
+    return version['count'], version['updated_at']
+
+
+def get_faq_index(bu_id):
+    """Cached FAQIndex of the business unit, rebuilt whenever its FAQ version changes."""
+    version = get_faq_version(bu_id)
+    faq_index = _faq_indexes.get(bu_id)
+    if faq_index is None or faq_index.version != version:
+        with _faq_index_locks_lock:
+            lock = _faq_index_locks.setdefault(bu_id, threading.Lock())
+        with lock:
+            faq_index = _faq_indexes.get(bu_id)
+            if faq_index is None or faq_index.version != version:
+                faq_index = FAQIndex.build(bu_id, version)
+                _faq_indexes[bu_id] = faq_index
+    return faq_index
+
+
+def find_exact_answer(bu_id, u_question):
+    """Answer of a FAQ variant equal to the question up to case, punctuation and whitespace, or None."""
+    return get_faq_index(bu_id).exact_answer(u_question)
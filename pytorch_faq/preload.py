@@ -0,0 +1,65 @@
+import gc
+
+import torch
+
+from eddy_school.settings import FAQ_SHARE_MEMORY, FAQ_TORCH_THREADS
+from pytorch_faq.registry import get_all_loaded
+
+MEMORY_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+
+def preload_faq_indexes():
+    # imported here: gunicorn calls after_fork before Django is set up when the app is not preloaded
+    from business_units.models import BusinessUnit
+    from pytorch_faq.index import get_faq_index
+
+    business_units = BusinessUnit.objects.filter(is_active=True, sqs__isnull=False).distinct()
+    for bu_id in business_units.values_list('id', flat=True):
+        get_faq_index(bu_id)
+
+
+def freeze_models():
+    for loaded in get_all_loaded():
+        for obj in loaded if isinstance(loaded, tuple) else (loaded,):
+            if isinstance(obj, torch.nn.Module):
+                obj.requires_grad_(False)
+                if FAQ_SHARE_MEMORY:
+                    obj.share_memory()
+
+
+def prepare_fork():
+    """Run in the parent once the app is preloaded, right before the workers are forked."""
+    try:
+        preload_faq_indexes()
+    except Exception as e:
+        print(f"FAQ INDEX PRELOAD FAILED: {e}")
+    try:
+        from document_index.preload import preload_document_indexes
+
+        preload_document_indexes()
+    except Exception as e:
+        print(f"DOCUMENT INDEX PRELOAD FAILED: {e}")
+    freeze_models()
+    from django.db import connections
+
+    # workers must open their own database connections
+    connections.close_all()
+    gc.collect()
+    # everything allocated so far is never traversed by the GC again, so the workers do not dirty those pages
+    gc.freeze()
+
+
+def after_fork():
+    if FAQ_TORCH_THREADS:
+        torch.set_num_threads(FAQ_TORCH_THREADS)
+
+
+def read_memory_usage(pid='self'):
+    """Memory of a process in kB. Pss and Private_* show how much of Rss is not shared with other workers."""
+    usage = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in MEMORY_FIELDS:
+                usage[name] = int(value.split()[0])
+    return usage
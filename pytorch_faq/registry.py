@@ -0,0 +1,20 @@
+import threading
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def get_loaded(key, loader):
+    """Return the process-wide object stored under key, calling loader() once on first use."""
+    loaded = _loaded.get(key)
+    if loaded is None:
+        with _loaded_lock:
+            loaded = _loaded.get(key)
+            if loaded is None:
+                loaded = loader()
+                _loaded[key] = loaded
+    return loaded
+
+
+def get_all_loaded():
+    return list(_loaded.values())
@@ -1,15 +1,48 @@
 import torch
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
-from business_units.models import BusinessUnit
+from eddy_school.settings import FAQ_BATCH_SIZE, FAQ_ENGINE, FAQ_MICROBATCH_WINDOW_MS, FAQ_MODEL_NAME, \
+    FAQ_MODEL_WARMUP, FAQ_PREFILTER_TOP_K
+from pytorch_faq.batching import MicroBatcher
+from pytorch_faq.cache import cache_match, get_cached_match
+from pytorch_faq.engines import FP32, build_engine
+from pytorch_faq.index import get_embedding_model, get_embeddings, get_faq_index, normalize_question
+from pytorch_faq.registry import get_loaded
 
+WARMUP_QUESTION = 'warmup'
 
-def load_model_and_tokenizer(model_name='cross-encoder/nli-distilroberta-base'):
-    tokenizer_p = AutoTokenizer.from_pretrained(model_name)
-    model_p = AutoModelForSequenceClassification.from_pretrained(model_name)
+
+def load_model_and_tokenizer(model_name=FAQ_MODEL_NAME, engine=FP32, local_files_only=False):
+    tokenizer_p = AutoTokenizer.from_pretrained(model_name, local_files_only=local_files_only)
+    model_p = AutoModelForSequenceClassification.from_pretrained(model_name, local_files_only=local_files_only)
+    model_p.eval()
+    return build_engine(engine, model_p, tokenizer_p, model_name), tokenizer_p
+
+
+def get_model_and_tokenizer(model_name=FAQ_MODEL_NAME, engine=FAQ_ENGINE, local_files_only=False):
+    """Return the process-wide model and tokenizer, loading them on first use."""
+    return get_loaded(('cross-encoder', model_name, engine),
+                      lambda: load_model_and_tokenizer(model_name, engine, local_files_only))
+
+
+def warmup_model(model_name=FAQ_MODEL_NAME, engine=FAQ_ENGINE):
+    model_p, tokenizer_p = get_model_and_tokenizer(model_name, engine)
+    get_similarity(WARMUP_QUESTION, WARMUP_QUESTION, model_p, tokenizer_p)
+    if FAQ_PREFILTER_TOP_K:
+        get_embeddings([WARMUP_QUESTION], *get_embedding_model())
     return model_p, tokenizer_p
 
 
+def warmup_on_startup():
+    """Worker boot hook: a failed warmup must not stop the worker, the model is loaded lazily anyway."""
+    if not FAQ_MODEL_WARMUP:
+        return
+    try:
+        warmup_model()
+    except Exception as e:
+        print(f"FAQ MODEL WARMUP FAILED: {e}")
+
+
 def get_similarity(u_question, sample_question, model_p, tokenizer_p):
     inputs = tokenizer_p(u_question, sample_question, return_tensors="pt", truncation=True)
     with torch.no_grad():
@@ -18,20 +51,53 @@ def get_similarity(u_question, sample_question, model_p, tokenizer_p):
     return similarity_p
 
 
+def score_pairs(u_questions, sample_questions, model_p, tokenizer_p, batch_size=FAQ_BATCH_SIZE):
+    """Score (u_questions[i], sample_questions[i]) pairs with one padded forward pass per batch."""
+    similarities = []
+    for start in range(0, len(sample_questions), batch_size):
+        inputs = tokenizer_p(u_questions[start:start + batch_size], sample_questions[start:start + batch_size],
+                             return_tensors="pt", padding=True, truncation=True)
+        with torch.no_grad():
+            outputs = model_p(**inputs)
+        similarities += torch.nn.functional.softmax(outputs.logits, dim=1)[:, 1].tolist()
+    return similarities
+
+
+def get_similarities(u_question, sample_questions, model_p, tokenizer_p, batch_size=FAQ_BATCH_SIZE):
+    """Score the question against every sample with one padded forward pass per batch."""
+    return score_pairs([u_question] * len(sample_questions), sample_questions, model_p, tokenizer_p, batch_size)
+
+
+def get_micro_batcher(engine=FAQ_ENGINE):
+    def score_pairs_with_engine(u_questions, sample_questions):
+        return score_pairs(u_questions, sample_questions, *get_model_and_tokenizer(engine=engine))
+
+    return get_loaded(('micro-batcher', engine), lambda: MicroBatcher(score_pairs_with_engine))
+
+
+def find_best_match(u_question, candidates, batch_size=FAQ_BATCH_SIZE, engine=FAQ_ENGINE):
+    if not candidates:
+        return None, 0
+    questions = [question for question, _ in candidates]
+    if FAQ_MICROBATCH_WINDOW_MS:
+        similarities = get_micro_batcher(engine).submit(u_question, questions)
+    else:
+        similarities = get_similarities(u_question, questions, *get_model_and_tokenizer(engine=engine),
+                                        batch_size=batch_size)
+    best_index = max(range(len(similarities)), key=similarities.__getitem__)
+    return candidates[best_index][1], similarities[best_index]
+
+
 def find_closest_answer(bu_id, u_question, similarity_threshold=0.7):
-    model_p, tokenizer_p = load_model_and_tokenizer()
-    business_unit = BusinessUnit.objects.get(id=bu_id)
-    faqs = business_unit.sqs.all()
-    best_similarity = 0
-    best_answer = None
-
-    for faq in faqs:
-        questions = faq.get_questions()
-        for question in questions:
-            similarity = get_similarity(u_question, question, model_p, tokenizer_p)
-            if similarity > best_similarity:
-                best_similarity = similarity
-                best_answer = faq.answer
+    faq_index = get_faq_index(bu_id)
+    question_key = normalize_question(u_question)
+    cached = get_cached_match(bu_id, faq_index.version, question_key)
+    if cached:
+        best_answer, best_similarity = cached
+    else:
+        candidates = faq_index.top_k(u_question, FAQ_PREFILTER_TOP_K)
+        best_answer, best_similarity = find_best_match(u_question, candidates)
+        cache_match(bu_id, faq_index.version, question_key, best_answer, best_similarity)
 
     if best_similarity >= similarity_threshold:
         print(f"ANSWER: {best_answer} \n POINTS: {best_similarity}")
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.client import UNAUTHORIZED
+
+import httpx
+from django.db import close_old_connections
+
+from business_units.models import BusinessUnit
+from eddy_school.settings import ASYNC_LLM_WORKERS, ASYNC_ORM_WORKERS, HTTP_MAX_CONNECTIONS, HTTP_TIMEOUT, \
+    SEND_PULSE_URL, SMART_SENDER_URL
+from restapi.v1.answering_gpt import utils as answering_utils
+from restapi.v1.answering_gpt.utils import determine_response_text
+from utils import get_send_pulse_messages, get_smart_sender_message, iter_text_parts, refresh_send_pulse_token, \
+    split_text_into_parts, translate_to_ukrainian
+
+# the blocking steps run in bounded pools, so a burst of webhooks queues up instead of starting a thread each
+orm_executor = ThreadPoolExecutor(ASYNC_ORM_WORKERS, thread_name_prefix='answering-orm')
+llm_executor = ThreadPoolExecutor(ASYNC_LLM_WORKERS, thread_name_prefix='answering-llm')
+
+# event loop -> its async client, dropped with the loop
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client():
+    """Async client of the running event loop, the requests served on that loop share its connection pool.
+
+    An httpx client can't be used on another loop. Under ASGI there is one loop per worker, under WSGI Django runs
+    every async view in a loop of its own.
+    """
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = _http_clients[loop] = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT, limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS)
+        )
+    return client
+
+
+async def close_http_client():
+    client = _http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def _call_with_connection(func, *args, **kwargs):
+    # pool threads outlive requests, so the end-of-request cleanup of connections never runs for them
+    close_old_connections()
+    return func(*args, **kwargs)
+
+
+async def run_blocking(executor, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, partial(_call_with_connection, func, *args, **kwargs)
+    )
+
+
+def get_request_data(request):
+    if request.content_type == 'application/json':
+        return json.loads(request.body or b'{}')
+    return request.POST
+
+
+async def update_send_pulse_if_needed(business_unit):
+    # the token manager is shared with the sync views, it only blocks when a token has to be requested
+    await run_blocking(orm_executor, answering_utils.update_send_pulse_if_needed, business_unit)
+
+
+async def post_message(business_unit, url, body):
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        url, token = f'{SEND_PULSE_URL}{url}', business_unit.sendpulse_token
+    else:
+        url, token = f'{SMART_SENDER_URL}{url}', business_unit.smart_sender_token
+    r = await get_http_client().post(url, headers={"Authorization": f"Bearer {token}"}, **body)
+    if r.status_code == UNAUTHORIZED and business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        token = await run_blocking(orm_executor, refresh_send_pulse_token, business_unit, stale_token=token)
+        r = await get_http_client().post(url, headers={"Authorization": f"Bearer {token}"}, **body)
+    return r.content.decode('utf-8')
+
+
+async def send_parts(business_unit, parts, contact_id, source_type):
+    """Async send_parts, the requests go out one after the other to keep the parts in order."""
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        messages = get_send_pulse_messages(source_type, contact_id, parts)
+    else:
+        messages = [get_smart_sender_message(contact_id, part) for part in parts]
+    return [await post_message(business_unit, url, body) for url, body in messages]
+
+
+async def send_part(business_unit, part, contact_id, source_type):
+    sent = await send_parts(business_unit, [part], contact_id, source_type)
+    return sent[0] if sent else None
+
+
+async def send_response(business_unit, user_q, text_parts, contact_id, source_type, response_text, llm_context):
+    # the parts of one answer go out in order, the concurrency is across requests
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        sendpulse_response = await send_parts(business_unit, text_parts, contact_id, source_type)
+        return {"user_question": user_q, "response": response_text, "chunks": llm_context,
+                "sendpulse_cont": sendpulse_response}
+    else:
+        r = await send_part(business_unit, response_text, contact_id, source_type)
+        return {"user_question": user_q, "response": response_text, "smart_sender": r}
+
+
+async def send_streaming_response(business_unit, user_q, response_q, contact_id, source_type):
+    """Async send_streaming_response, the LLM stream is read in the LLM pool."""
+    use_default_text = business_unit.bot_mode == BusinessUnit.STRICT_MODE and \
+        float(response_q['eval_result']) < business_unit.eval_score
+    sent = []
+    parts = iter_text_parts(response_q['response_gen'])
+    while (part := await run_blocking(llm_executor, next, parts, None)) is not None:
+        if not sent and business_unit.bot_mode != BusinessUnit.STRICT_MODE and part.startswith("I'm sorry"):
+            use_default_text = True
+        if not use_default_text:
+            sent.append(await send_part(business_unit, translate_to_ukrainian(part), contact_id, source_type))
+    if use_default_text:
+        sent = await send_parts(business_unit, split_text_into_parts(business_unit.default_text), contact_id,
+                                source_type)
+
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        return {"user_question": user_q, "response": response_q['response'], "chunks": response_q['llm_context'],
+                "sendpulse_cont": sent}
+    return {"user_question": user_q, "response": response_q['response'], "smart_sender": '\n'.join(sent)}
+
+
+async def process_response(business_unit, user_q, response_q, contact_id, source_type):
+    if response_q.get('response_gen'):
+        return await send_streaming_response(business_unit, user_q, response_q, contact_id, source_type)
+    response = determine_response_text(business_unit, response_q)
+    text_parts = split_text_into_parts(response)
+    return await send_response(business_unit, user_q, text_parts, contact_id, source_type, response_q['response'],
+                               response_q['llm_context'])
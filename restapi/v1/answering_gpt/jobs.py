@@ -0,0 +1,112 @@
+import datetime
+import threading
+import traceback
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chat_history.models import AnswerJob
+from eddy_school.settings import ANSWER_JOB_LEASE, ANSWER_JOB_MAX_ATTEMPTS
+from restapi.v1.answering_gpt.utils import generate_response, get_query_params, process_response, \
+    save_chat_history, update_send_pulse_if_needed
+
+RETRY_DELAY = datetime.timedelta(seconds=30)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def enqueue_answer_job(business_unit, data):
+    return AnswerJob.objects.create(business_unit=business_unit, payload={key: data.get(key) for key in data})
+
+
+def claim_answer_job(lease=ANSWER_JOB_LEASE):
+    """Take the oldest job that is due, or None. Running jobs whose lease ran out are taken over."""
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            job = (
+                AnswerJob.objects.select_for_update(skip_locked=True)
+                .filter(status__in=(AnswerJob.PENDING, AnswerJob.RUNNING))
+                .filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+                .order_by('created_at').first()
+            )
+            if job is None:
+                return None
+            if job.attempts >= ANSWER_JOB_MAX_ATTEMPTS:
+                job.status = AnswerJob.FAILED
+                job.error = job.error or "The worker running the job stopped before finishing it."
+                job.save(update_fields=['status', 'error', 'updated_at'])
+                continue
+            # the attempts condition keeps the claim exclusive on databases without row locks
+            claimed = AnswerJob.objects.filter(id=job.id, attempts=job.attempts).update(
+                status=AnswerJob.RUNNING, attempts=job.attempts + 1, locked_until=now + datetime.timedelta(
+                    seconds=lease), updated_at=now
+            )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def update_claimed_job(job, **fields):
+    """Update the job only while this worker holds it: every claim increments attempts."""
+    return AnswerJob.objects.filter(id=job.id, attempts=job.attempts, status=AnswerJob.RUNNING).update(
+        updated_at=timezone.now(), **fields
+    )
+
+
+def renew_lease(job, stop, lost):
+    """Extend the lease until stop is set, an LLM call or a slow send may take longer than one lease."""
+    try:
+        while not stop.wait(ANSWER_JOB_LEASE / 3):
+            if not update_claimed_job(job, locked_until=timezone.now() + datetime.timedelta(
+                    seconds=ANSWER_JOB_LEASE)):
+                lost.set()
+                return
+    finally:
+        connection.close()
+
+
+def deliver_answer(job, query_params, lost):
+    business_unit = job.business_unit
+    update_send_pulse_if_needed(business_unit)
+    response_q = generate_response(query_text=query_params['query_text'],
+                                   business_unit=business_unit,
+                                   document_id=query_params['document_id'],
+                                   llm_context=query_params['llm_context'])
+    # another worker took the job over meanwhile and sends the answer itself
+    if lost.is_set():
+        raise LeaseLost(f"Job {job.id} was taken over by another worker.")
+    process_response(business_unit=business_unit,
+                     user_q=query_params['query_text'],
+                     response_q=response_q,
+                     contact_id=query_params['contact_id'],
+                     source_type=query_params['source_type'])
+    update_claimed_job(job, delivered_at=timezone.now(), answer=response_q['response'])
+    return response_q['response']
+
+
+def run_answer_job(job):
+    """Answer the job once it is claimed. The answer is sent only once: a retry after the delivery just saves the
+    chat history. Nothing is saved when another worker took the job over."""
+    query_params = get_query_params(job.payload)
+    stop, lost = threading.Event(), threading.Event()
+    heartbeat = threading.Thread(target=renew_lease, args=(job, stop, lost), daemon=True)
+    heartbeat.start()
+    try:
+        answer = job.answer if job.delivered_at else deliver_answer(job, query_params, lost)
+        save_chat_history(job.business_unit, query_params, job.payload, answer)
+    except Exception:
+        if job.attempts < ANSWER_JOB_MAX_ATTEMPTS:
+            update_claimed_job(job, status=AnswerJob.PENDING, error=traceback.format_exc(),
+                               locked_until=timezone.now() + RETRY_DELAY * job.attempts)
+        else:
+            update_claimed_job(job, status=AnswerJob.FAILED, error=traceback.format_exc(), locked_until=None)
+        raise
+    finally:
+        stop.set()
+        heartbeat.join()
+    if not update_claimed_job(job, status=AnswerJob.DONE, locked_until=None):
+        raise LeaseLost(f"Job {job.id} was taken over by another worker.")
@@ -3,5 +3,6 @@ from django.urls import path
 from restapi.v1.answering_gpt import views
 
 urlpatterns = [
-    path("", views.GPTAnswerView.as_view())
+    path("", views.GPTAnswerView.as_view()),
+    path("async/", views.AsyncGPTAnswerView.as_view()),
 ]
@@ -1,19 +1,19 @@
-import datetime
-
 from django.http import HttpResponse
 
 from business_units.models import BusinessUnit, Document
+from eddy_school.settings import LLM_STREAMING
+from restapi.v1.document.utils import create_chat_history
 from utils import (
     make_query, translate_to_ukrainian, send_pulse_flow,
-    gpt_assistant_query, smart_sender_flow, split_text_into_parts
+    gpt_assistant_query, smart_sender_flow, split_text_into_parts,
+    get_documents_folder, get_index_name, get_google_creds_path, iter_text_parts, get_send_pulse_token
 )
 
 
 def update_send_pulse_if_needed(business_unit):
-    datetime_now = datetime.datetime.now(datetime.timezone.utc)
-    if (not business_unit.sendpulse_token or
-            datetime_now - business_unit.last_update_sendpulse > datetime.timedelta(minutes=50)):
-        send_pulse_flow(request_type="auth", business_units=business_unit)
+    # a memory lookup unless the token is missing or expired, so the answer can be sent without waiting for one
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        get_send_pulse_token(business_unit)
 
 
 def get_business_unit(apikey):
@@ -25,11 +25,11 @@ def get_business_unit(apikey):
     return business_unit, None
 
 
-def get_query_params(request):
+def get_query_params(data):
     required_params = ['query_text', 'apikey', 'contact_id', 'source_type']
-    params = {param: request.data.get(param, None) for param in required_params}
-    params['llm_context'] = request.data.get('llm_context', None)
-    params['document_id'] = [request.data.get('document_id'), ] if request.data.get('document_id', None) else None
+    params = {param: data.get(param, None) for param in required_params}
+    params['llm_context'] = data.get('llm_context', None)
+    params['document_id'] = [data.get('document_id'), ] if data.get('document_id', None) else None
 
     if not params['apikey']:
         return {'error': HttpResponse("Apikey parameters are missing", status=401)}
@@ -43,12 +43,14 @@ def generate_response(query_text, business_unit, document_id, llm_context):
             document_id = list(Document.objects.filter(business_unit=business_unit).values_list('document_id', flat=True))
             resave_documents = False
         return make_query(
-            query_text, document_id, f"./documents-{business_unit.apikey}",
-            f"./saved_index-{business_unit.apikey}", business_unit.gpt_api_key,
-            f"eddy_school/media/google_creds/{business_unit.google_creds.url.split('/')[3]}",
-            resave_documents
+            query_text, document_id, get_documents_folder(business_unit),
+            get_index_name(business_unit), business_unit.gpt_api_key,
+            get_google_creds_path(business_unit),
+            resave_documents,
+            streaming=LLM_STREAMING
         )
     else:
+        # assistant runs can't be streamed with the pinned openai client, the answer is sent whole
         return gpt_assistant_query(query_text, business_unit, business_unit.gpt_api_key)
 
 
@@ -61,13 +63,30 @@ def determine_response_text(business_unit, response_q):
     return translate_to_ukrainian(response_q['response'])
 
 
+def send_part(business_unit, part, contact_id, source_type):
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        r = send_pulse_flow(request_type="send_message", business_units=business_unit, contact_id=contact_id,
+                            part=part, source_type=source_type)
+    else:
+        r = smart_sender_flow(request_type="send_message", business_units=business_unit, contact_id=contact_id,
+                              response=part)
+    return r.content.decode('utf-8')
+
+
+def send_parts(business_unit, parts, contact_id, source_type):
+    """Send the parts in order, to SendPulse in as few requests as the channel allows. Returns the replies."""
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        responses = send_pulse_flow(request_type="send_messages", business_units=business_unit, contact_id=contact_id,
+                                    parts=parts, source_type=source_type)
+    else:
+        responses = [smart_sender_flow(request_type="send_message", business_units=business_unit,
+                                       contact_id=contact_id, response=part) for part in parts]
+    return [r.content.decode('utf-8') for r in responses]
+
+
 def send_response(business_unit, user_q, text_parts, contact_id, source_type, response_text, llm_context):
     if business_unit.sending_service == BusinessUnit.SEND_PULSE:
-        sendpulse_response = [
-            send_pulse_flow(request_type="send_message", business_units=business_unit, contact_id=contact_id,
-                            part=part, source_type=source_type).content.decode('utf-8')
-            for part in text_parts
-        ]
+        sendpulse_response = send_parts(business_unit, text_parts, contact_id, source_type)
         return {"user_question": user_q, "response": response_text, "chunks": llm_context,
                 "sendpulse_cont": sendpulse_response}
     else:
@@ -77,8 +96,58 @@ def send_response(business_unit, user_q, text_parts, contact_id, source_type, re
                 "smart_sender": r.content.decode('utf-8')}
 
 
+def send_streaming_response(business_unit, user_q, response_q, contact_id, source_type):
+    """Send every part of a streamed answer as soon as it is complete, the rules of determine_response_text apply.
+
+    response_q["response"] holds the whole answer afterwards.
+    """
+    use_default_text = business_unit.bot_mode == BusinessUnit.STRICT_MODE and \
+        float(response_q['eval_result']) < business_unit.eval_score
+    sent = []
+    for part in iter_text_parts(response_q['response_gen']):
+        if not sent and business_unit.bot_mode != BusinessUnit.STRICT_MODE and part.startswith("I'm sorry"):
+            use_default_text = True
+        if not use_default_text:
+            sent.append(send_part(business_unit, translate_to_ukrainian(part), contact_id, source_type))
+    if use_default_text:
+        sent = send_parts(business_unit, split_text_into_parts(business_unit.default_text), contact_id, source_type)
+
+    if business_unit.sending_service == BusinessUnit.SEND_PULSE:
+        return {"user_question": user_q, "response": response_q['response'], "chunks": response_q['llm_context'],
+                "sendpulse_cont": sent}
+    return {"user_question": user_q, "response": response_q['response'], "smart_sender": '\n'.join(sent)}
+
+
 def process_response(business_unit, user_q, response_q, contact_id, source_type):
+    if response_q.get('response_gen'):
+        return send_streaming_response(business_unit, user_q, response_q, contact_id, source_type)
     response = determine_response_text(business_unit, response_q)
     text_parts = split_text_into_parts(response)
     return send_response(business_unit, user_q, text_parts, contact_id, source_type, response_q['response'],
                          response_q['llm_context'])
+
+
+def answer_query(business_unit, query_params, data):
+    """Generate the answer, send it and save it to the chat history. Returns what was sent."""
+    update_send_pulse_if_needed(business_unit)
+    response_q = generate_response(query_text=query_params['query_text'],
+                                   business_unit=business_unit,
+                                   document_id=query_params['document_id'],
+                                   llm_context=query_params['llm_context'])
+    final_response = process_response(business_unit=business_unit,
+                                      user_q=query_params['query_text'],
+                                      response_q=response_q,
+                                      contact_id=query_params['contact_id'],
+                                      source_type=query_params['source_type'])
+    save_chat_history(business_unit, query_params, data, response_q['response'])
+    return final_response
+
+
+def save_chat_history(business_unit, query_params, data, answer):
+    create_chat_history(
+        business_unit=business_unit,
+        username=data.get('username'),
+        user_id=data.get('user_id'),
+        user_question=query_params['query_text'],
+        system_answer=answer
+    )
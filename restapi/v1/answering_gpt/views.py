@@ -1,8 +1,15 @@
+from django.core.handlers.asgi import ASGIRequest
 from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 
-from restapi.v1.answering_gpt.utils import get_query_params, get_business_unit, update_send_pulse_if_needed, \
-    generate_response, process_response
+from eddy_school.settings import ANSWERING_QUEUE
+from restapi.v1.answering_gpt import async_utils
+from restapi.v1.answering_gpt.async_utils import get_request_data, llm_executor, orm_executor, run_blocking
+from restapi.v1.answering_gpt.jobs import enqueue_answer_job
+from restapi.v1.answering_gpt.utils import get_query_params, get_business_unit, generate_response, answer_query
 from restapi.v1.document.utils import create_chat_history
 
 
@@ -23,10 +30,10 @@ class GPTAnswerView(APIView):
                         - "source_type: тип зв'язку.
                         - "document_id: ід документу (Для лендінг пейджа).
 
-                    Response: 200
+                    Response: 200, або 202 з "job_id", коли відповіді надсилає черга (ANSWERING_QUEUE).
                 """
 
-        query_params = get_query_params(request)
+        query_params = get_query_params(request.data)
         if query_params.get('error', None):
             return query_params['error']
 
@@ -34,22 +41,66 @@ class GPTAnswerView(APIView):
         if response:
             return response
 
-        update_send_pulse_if_needed(business_unit)
-        response_q = generate_response(query_text=query_params['query_text'],
-                                       business_unit=business_unit,
-                                       document_id=query_params['document_id'],
-                                       llm_context=query_params['llm_context'])
-        final_response = process_response(business_unit=business_unit,
-                                          user_q=query_params['query_text'],
-                                          response_q=response_q,
-                                          contact_id=query_params['contact_id'],
-                                          source_type=query_params['source_type'])
-        create_chat_history(
-            business_unit=business_unit,
-            username=request.data.get('username'),
-            user_id=request.data.get('user_id'),
-            user_question=query_params['query_text'],
-            system_answer=response_q['response']
-        )
+        if ANSWERING_QUEUE:
+            job = enqueue_answer_job(business_unit, request.data)
+            return JsonResponse({"job_id": job.id}, status=202)
+
+        return JsonResponse(answer_query(business_unit, query_params, request.data))
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncGPTAnswerView(View):
+
+    async def post(self, request):
+
+        """
+                Description.
+
+                    URL: /api/1.0/answering_gpt/async/
+
+                    Те саме, що й /api/1.0/answering_gpt/, для ASGI: запит не займає потік, поки чекає
+                    на LLM і на відправку повідомлень.
+
+                    Response: 200
+                """
+
+        try:
+            return await self.answer(request)
+        finally:
+            # under WSGI the event loop ends with the request, its connections can't be reused
+            if not isinstance(request, ASGIRequest):
+                await async_utils.close_http_client()
+
+    async def answer(self, request):
+        data = get_request_data(request)
+        query_params = get_query_params(data)
+        if query_params.get('error', None):
+            return query_params['error']
+
+        business_unit, response = await run_blocking(orm_executor, get_business_unit, query_params['apikey'])
+        if response:
+            return response
+
+        if ANSWERING_QUEUE:
+            job = await run_blocking(orm_executor, enqueue_answer_job, business_unit, data)
+            return JsonResponse({"job_id": job.id}, status=202)
+
+        await async_utils.update_send_pulse_if_needed(business_unit)
+        response_q = await run_blocking(llm_executor, generate_response,
+                                        query_text=query_params['query_text'],
+                                        business_unit=business_unit,
+                                        document_id=query_params['document_id'],
+                                        llm_context=query_params['llm_context'])
+        final_response = await async_utils.process_response(business_unit=business_unit,
+                                                            user_q=query_params['query_text'],
+                                                            response_q=response_q,
+                                                            contact_id=query_params['contact_id'],
+                                                            source_type=query_params['source_type'])
+        await run_blocking(orm_executor, create_chat_history,
+                           business_unit=business_unit,
+                           username=data.get('username'),
+                           user_id=data.get('user_id'),
+                           user_question=query_params['query_text'],
+                           system_answer=response_q['response'])
 
         return JsonResponse(final_response)
@@ -1,27 +1,47 @@
 from __future__ import annotations
 from __future__ import annotations
 
+import copy
 import datetime
 import io
 import json
 import os
+import re
 import shutil
+import threading
 import time
-from http.client import OK
+from collections import namedtuple
+from concurrent.futures import Future
+from http.cookiejar import DefaultCookiePolicy
+from http.client import OK, UNAUTHORIZED
 
 import googleapiclient.discovery as discovery
+import httpx
 import openai
 import requests
+from filelock import Timeout
 from googleapiclient.errors import HttpError
 from httplib2 import Http
-from llama_index import GPTVectorStoreIndex, ServiceContext, SimpleDirectoryReader, \
-    load_index_from_storage, StorageContext
+from llama_index import GPTVectorStoreIndex, QueryBundle, ServiceContext, load_index_from_storage
+from llama_index.embeddings import OpenAIEmbedding
 from llama_index.llms import OpenAI
+from llama_index.response.schema import StreamingResponse
 from llama_index.schema import Document
 from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from business_units.models import BusinessUnit
-from eddy_school.settings import SEND_PULSE_URL, SMART_SENDER_URL
+from document_index.cache import get_directory_size, index_cache
+from document_index.embeddings import CachedEmbedding
+from document_index.responses import cache_response, get_cached_response
+from document_index.storage import get_index_lock, get_index_path, new_index_version, publish_index_version
+from document_index.vector_store import get_storage_context
+from eddy_school.settings import DOCUMENTS_BACKGROUND_SYNC, EMBEDDING_CACHE_PATH, HTTP_MAX_CONNECTIONS, \
+    HTTP_POOL_SIZE, HTTP_RETRIES, HTTP_RETRY_BACKOFF, HTTP_TIMEOUT, LLM_STREAM_MIN_FIRST_PART_LENGTH, \
+    LLM_STREAM_MIN_PART_LENGTH, SEND_PULSE_MAX_MESSAGES_PER_REQUEST, SEND_PULSE_TOKEN_REFRESH_AHEAD, \
+    SEND_PULSE_TOKEN_TTL, SEND_PULSE_URL, SMART_SENDER_URL
+from pytorch_faq.index import find_exact_answer
 from pytorch_faq.utils import find_closest_answer
 
 SEND_PULSE_AUTH = '/oauth/access_token'
@@ -39,8 +59,33 @@ SMART_SENDER_MESSAGE = '/v1/contacts/{contactId}/send'
 SMART_SENDER_RUN_BY_TRIGGER = '/v1/contacts/{contactId}/fire'
 
 SCOPES = ['https://www.googleapis.com/auth/documents.readonly', 'https://www.googleapis.com/auth/drive']
-DISCOVERY_DOC = 'https://docs.googleapis.com/$discovery/rest?version=v1'
-DISCOVERY_DRIVE = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+GOOGLE_BATCH_LIMIT = 100
+DRIVE_FILE_FIELDS = 'modifiedTime,version'
+DOCUMENTS_MANIFEST = 'documents.json'
+
+HEADING = 'heading'
+PARAGRAPH = 'paragraph'
+TABLE_ROW = 'table_row'
+HEADING_LEVELS = {'TITLE': 0, **{f'HEADING_{level}': level for level in range(1, 7)}}
+# documents are split into sections at the title and first and second level headings
+SECTION_HEADING_LEVEL = 2
+
+DocumentSegment = namedtuple('DocumentSegment', 'kind level text')
+
+# end of a sentence: terminal punctuation once the whitespace after it has arrived, or a line break
+SENTENCE_END_RE = re.compile(r'[.!?…]+["»)]*(?=\s)|\n')
+# words whose dot doesn't end a sentence: list markers ("1.", "a.") and abbreviations ("e.g.")
+NOT_SENTENCE_END_RE = re.compile(r'\d+\.|\w\.|(?:\w\.){2,}')
+
+_google_credentials = {}
+_google_services = threading.local()
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+_openai_http_client = None
+# sendpulse_id -> (access token, time it was issued), and the refreshes in flight
+_send_pulse_tokens = {}
+_send_pulse_refreshes = {}
+_send_pulse_tokens_lock = threading.Lock()
 
 REFINE_PROMPT = (
     """
@@ -60,11 +105,112 @@ REFINE_PROMPT = (
 )
 
 
+class PooledSession(requests.Session):
+    """requests.Session with a default timeout, requests waits forever without one."""
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', HTTP_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+
+def get_http_session(base_url):
+    """Keep-alive session for a provider base URL, its connection pool is shared by all threads of the process.
+
+    Only failed connects are retried: the request was not sent then, so retrying a POST can't send a message twice.
+    """
+    session = _http_sessions.get(base_url)
+    if session is None:
+        with _http_sessions_lock:
+            session = _http_sessions.get(base_url)
+            if session is None:
+                session = PooledSession()
+                # the session serves every business unit, cookies of one must not go out with another
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                retry = Retry(total=HTTP_RETRIES, connect=HTTP_RETRIES, read=0, status=0,
+                              backoff_factor=HTTP_RETRY_BACKOFF)
+                session.mount(base_url, HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=retry))
+                _http_sessions[base_url] = session
+    return session
+
+
+def get_openai_http_client():
+    """httpx client shared by the OpenAI clients of the assistant mode, one is built per query."""
+    global _openai_http_client
+    if _openai_http_client is None:
+        _openai_http_client = httpx.Client(
+            timeout=openai.DEFAULT_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_POOL_SIZE),
+        )
+    return _openai_http_client
+
+
 def get_credentials(file_url):
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        file_url, SCOPES
-    )
-    return credentials
+    """Service account credentials, parsed once per key file and again only when the file changes."""
+    modified = os.path.getmtime(file_url)
+    cached = _google_credentials.get(file_url)
+    if cached is None or cached[0] != modified:
+        credentials = ServiceAccountCredentials.from_json_keyfile_name(
+            file_url, SCOPES
+        )
+        cached = (modified, credentials)
+        _google_credentials[file_url] = cached
+    return cached[1]
+
+
+def get_google_services(file_url):
+    """Authorized docs and drive services, built once per thread (httplib2.Http is not thread-safe).
+
+    The discovery documents come from the static copies bundled with google-api-python-client, so building a
+    service makes no HTTP requests.
+    """
+    credentials = get_credentials(file_url)
+    if not hasattr(_google_services, 'by_file'):
+        _google_services.by_file = {}
+    cached = _google_services.by_file.get(file_url)
+    if cached is None or cached[0] is not credentials:
+        http = credentials.authorize(Http())
+        docs_service = discovery.build('docs', 'v1', http=http, static_discovery=True)
+        drive = discovery.build('drive', 'v3', http=http, static_discovery=True)
+        cached = (credentials, docs_service, drive)
+        _google_services.by_file[file_url] = cached
+    return cached[1], cached[2]
+
+
+def execute_batched(service, api_requests):
+    """Execute requests of one service in as few batch HTTP calls as possible; responses are in request order."""
+    if len(api_requests) == 1:
+        return [api_requests[0].execute()]
+
+    responses = [None] * len(api_requests)
+    errors = []
+
+    def collect(request_id, response, exception):
+        if exception:
+            errors.append(exception)
+        else:
+            responses[int(request_id)] = response
+
+    for start in range(0, len(api_requests), GOOGLE_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=collect)
+        for i, api_request in enumerate(api_requests[start:start + GOOGLE_BATCH_LIMIT], start):
+            batch.add(api_request, request_id=str(i))
+        batch.execute()
+        if errors:
+            raise errors[0]
+    return responses
+
+
+def fetch_documents(docs_service, document_ids):
+    return execute_batched(docs_service, [
+        docs_service.documents().get(documentId=document_id) for document_id in document_ids
+    ])
+
+
+def fetch_files_metadata(drive, document_ids):
+    """Only modifiedTime and version of every file."""
+    return execute_batched(drive, [
+        drive.files().get(fileId=document_id, fields=DRIVE_FILE_FIELDS) for document_id in document_ids
+    ])
 
 
 def read_paragraph_element(element):
@@ -74,23 +220,61 @@ def read_paragraph_element(element):
     return text_run.get('content')
 
 
-def read_structural_elements(elements):
-    text = ''
+def iter_structural_elements(elements):
+    """Segments of a Google Docs body in document order: headings with their level, paragraphs and table rows."""
     for value in elements:
         if 'paragraph' in value:
-            elements = value.get('paragraph').get('elements')
-            for elem in elements:
-                text += read_paragraph_element(elem)
+            paragraph = value.get('paragraph')
+            text = ''.join(read_paragraph_element(elem) for elem in paragraph.get('elements'))
+            level = HEADING_LEVELS.get(paragraph.get('paragraphStyle', {}).get('namedStyleType'))
+            yield DocumentSegment(PARAGRAPH if level is None else HEADING, level, text)
         elif 'table' in value:
-            table = value.get('table')
-            for row in table.get('tableRows'):
-                cells = row.get('tableCells')
-                for cell in cells:
-                    text += read_structural_elements(cell.get('content'))
+            for row in value.get('table').get('tableRows'):
+                cells = [read_structural_elements(cell.get('content')).strip() for cell in row.get('tableCells')]
+                yield DocumentSegment(TABLE_ROW, None, ' | '.join(cells) + '\n')
         elif 'tableOfContents' in value:
-            toc = value.get('tableOfContents')
-            text += read_structural_elements(toc.get('content'))
-    return text
+            yield from iter_structural_elements(value.get('tableOfContents').get('content'))
+
+
+def read_structural_elements(elements):
+    return ''.join(segment.text for segment in iter_structural_elements(elements))
+
+
+def read_sections(elements):
+    """(heading, text) pairs of a Google Docs body split at its top-level headings.
+
+    The text before the first heading comes with an empty heading; blank sections are left out.
+    """
+    sections = [('', [])]
+    for segment in iter_structural_elements(elements):
+        if segment.kind == HEADING and segment.level <= SECTION_HEADING_LEVEL and segment.text.strip():
+            sections.append((segment.text.strip(), []))
+        sections[-1][1].append(segment.text)
+    sections = [(heading, ''.join(texts)) for heading, texts in sections]
+    return [(heading, text) for heading, text in sections if text.strip()]
+
+
+def read_section_documents(document_id, doc):
+    """One Document per section, with ids that stay the same when other sections change.
+
+    Chunks don't cross section boundaries and an edit only re-embeds the sections it touched.
+    """
+    documents = []
+    heading_counts = {}
+    for heading, text in read_sections(doc.get('body').get('content')):
+        heading_counts[heading] = heading_counts.get(heading, 0) + 1
+        section_id = f"{document_id}#{heading}"
+        if heading_counts[heading] > 1:
+            section_id += f"#{heading_counts[heading]}"
+        documents.append(Document(
+            doc_id=section_id,
+            text=text,
+            metadata={'title': doc.get('title', ''), 'section': heading},
+            # for reference only: the heading is in the text already, and metadata counts against the chunk size
+            excluded_embed_metadata_keys=['title', 'section'],
+            excluded_llm_metadata_keys=['title', 'section'],
+        ))
+    return documents
 
 
 def run_correctness_eval(
@@ -130,121 +314,270 @@ def run_correctness_eval(
             return {"score": score}
 
 
-def make_query(query_text, document_ids, documents_folder, index_name, openai_key, file_url, resave_documents=False):
+def get_documents_folder(business_unit):
+    return f"./documents-{business_unit.apikey}"
+
+
+def get_index_name(business_unit):
+    return f"./saved_index-{business_unit.apikey}"
+
+
+def get_google_creds_path(business_unit):
+    return f"eddy_school/media/google_creds/{business_unit.google_creds.url.split('/')[3]}"
+
+
+def use_openai_key(openai_key):
     openai.api_key = openai_key
     os.environ["OPENAI_API_KEY"] = openai.api_key
-    credentials = get_credentials(file_url)
-    http = credentials.authorize(Http())
-    business_unit = BusinessUnit.objects.filter(apikey=documents_folder.split('documents-')[1]).first()
 
-    closest_answer = find_closest_answer(business_unit.id, query_text, business_unit.similarity_simple_q)
-    if closest_answer:
-        return {"response": closest_answer, "eval_result": 5,
-                "llm_context": 'None'}
 
-    if not business_unit.last_used_documents_list:
-        resave_documents = True
-        business_unit.last_used_documents_list = document_ids
-        business_unit.save()
-    elif document_ids != eval(business_unit.last_used_documents_list):
-        resave_documents = True
-        business_unit.last_used_documents_list = document_ids
-        business_unit.save()
+def get_service_context(business_unit):
+    temperature = business_unit.temperature
+    if business_unit.max_tokens:
+        llm = OpenAI(model=business_unit.gpt_model, temperature=temperature,
+                     max_tokens=business_unit.max_tokens, api_key=business_unit.gpt_api_key)
+    else:
+        llm = OpenAI(model=business_unit.gpt_model, temperature=temperature, api_key=business_unit.gpt_api_key)
 
-    docs_service = discovery.build(
-        'docs', 'v1', http=http, discoveryServiceUrl=DISCOVERY_DOC)
+    # the key is given explicitly, the environment is shared by concurrent requests of other units
+    embed_model = OpenAIEmbedding(api_key=business_unit.gpt_api_key)
+    if EMBEDDING_CACHE_PATH:
+        embed_model = CachedEmbedding(embed_model)
 
-    docs = []
+    return ServiceContext.from_defaults(
+        llm=llm,
+        embed_model=embed_model,
+        system_prompt=business_unit.system_prompt,
+        chunk_size=business_unit.chunk_size if business_unit.chunk_size else None,
+        chunk_overlap=business_unit.chunk_overlap if business_unit.chunk_overlap else None
+    )
 
-    for document_id in document_ids:
-        try:
-            doc = docs_service.documents().get(documentId=document_id).execute()
-            docs.append(doc)
-        except HttpError:
-            return {
-                "response": business_unit.panic_text if business_unit.panic_text else "The provided file is not in the "
-                                                                                      "public domain or the document ID "
-                                                                                      "is incorrect.",
-                "eval_result": 5,
-                "llm_context": None
-            }
 
-    doc_content = []
-    doc_title = ""
-    for doc in docs:
-        doc_content += doc.get('body').get('content')
-        doc_title += doc.get('title', '')
+def documents_list_changed(business_unit, document_ids):
+    return not business_unit.last_used_documents_list or document_ids != eval(business_unit.last_used_documents_list)
 
-    drive = discovery.build("drive", "v3", http=http, discoveryServiceUrl=DISCOVERY_DRIVE)
 
-    last_modified = datetime.datetime.min
+def record_documents_list(business_unit, document_ids):
+    """Remember the documents the saved index is built from, once it is."""
+    if documents_list_changed(business_unit, document_ids):
+        business_unit.last_used_documents_list = str(document_ids)
+        business_unit.save(update_fields=['last_used_documents_list'])
 
-    for document_id in document_ids:
-        modified_time = drive.files().get(fileId=document_id, fields='*').execute()['modifiedTime']
-        modified_datetime = datetime.datetime.strptime(modified_time, '%Y-%m-%dT%H:%M:%S.%fZ')
 
-        if modified_datetime > last_modified:
-            last_modified = modified_datetime
+def read_documents_manifest(index_path):
+    """Drive version of every document in the saved index, by document id; None for an index without one."""
+    try:
+        with io.open(os.path.join(index_path, DOCUMENTS_MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
 
-    if resave_documents:
-        business_unit.last_update_document = None
-        business_unit.save()
 
-        if os.path.exists(documents_folder):
-            shutil.rmtree(documents_folder)
-        if os.path.exists(index_name):
-            shutil.rmtree(index_name)
+def write_documents_manifest(index_path, manifest):
+    with io.open(os.path.join(index_path, DOCUMENTS_MANIFEST), 'w') as f:
+        json.dump(manifest, f)
 
-    filename = os.path.join(documents_folder, doc_title + '.txt')
 
-    if not os.path.exists(documents_folder) or not business_unit.last_update_document:
+def get_index_version(index_path):
+    """Changes every time the index is persisted, None when there is no saved index."""
+    if index_path is None:
+        return None
+    for file_name in (DOCUMENTS_MANIFEST, 'docstore.json'):
         try:
-            os.mkdir(documents_folder)
-        except:
+            return index_path, os.stat(os.path.join(index_path, file_name)).st_mtime_ns
+        except FileNotFoundError:
             pass
-        business_unit.last_update_document = last_modified
-        business_unit.save()
-    elif business_unit.last_update_document.strftime('%Y-%m-%dT%H:%M:%S.%fZ') < last_modified.strftime(
-            '%Y-%m-%dT%H:%M:%S.%fZ'):
-        if os.path.exists(documents_folder):
-            shutil.rmtree(documents_folder)
-        if os.path.exists(index_name):
-            shutil.rmtree(index_name)
-
-        os.mkdir(documents_folder)
-        business_unit.last_update_document = last_modified
-        business_unit.save()
-    with io.open(filename, 'wb') as f:
-        f.write(read_structural_elements(doc_content).encode('utf-8'))
-        temperature = business_unit.temperature
-    if business_unit.max_tokens:
-        llm = OpenAI(model=business_unit.gpt_model, temperature=temperature,
-                     max_tokens=business_unit.max_tokens)
-    else:
-        llm = OpenAI(model=business_unit.gpt_model, temperature=temperature)
+    return None
 
-    service_context = ServiceContext.from_defaults(
-        llm=llm,
-        system_prompt=business_unit.system_prompt,
-        chunk_size=business_unit.chunk_size if business_unit.chunk_size else None,
-        chunk_overlap=business_unit.chunk_overlap if business_unit.chunk_overlap else None
+
+def cache_index(index_name, openai_key, index, index_path):
+    # the embedding model of a loaded index keeps the key it was loaded with
+    version = (get_index_version(index_path), openai_key)
+    index_cache.put(index_name, version, index, get_directory_size(index_path))
+
+
+def get_index(index_name, openai_key, service_context):
+    """The saved index and the version directory it comes from, loaded from disk only when it was persisted again
+    since the last load."""
+    # resolved once, so every file is read from the same version even if a new one is published meanwhile
+    index_path = get_index_path(index_name)
+    version = (get_index_version(index_path), openai_key)
+    index = index_cache.get(index_name, version)
+    if index is None:
+        index = load_index_from_storage(get_storage_context(index_path), service_context=service_context)
+        index_cache.put(index_name, version, index, get_directory_size(index_path))
+    return index, index_path
+
+
+def get_response_version(business_unit, index_path):
+    """Cached responses hold while the index version and the unit settings that shape an answer are the same.
+
+    index_path is the version directory the answering index was loaded from, not the one published now.
+    """
+    return (
+        get_index_version(index_path), business_unit.gpt_model, business_unit.temperature,
+        business_unit.max_tokens, business_unit.system_prompt, business_unit.similarity_top_k,
     )
-    if os.path.exists(index_name):
-        index = load_index_from_storage(
-            StorageContext.from_defaults(persist_dir=index_name),
-            service_context=service_context,
-        )
+
+
+def sync_documents(business_unit, document_ids, documents_folder, index_name, file_url, service_context,
+                   resave_documents=False):
+    """Bring the saved index in line with the Google Docs, re-embedding only the sections whose text changed.
+
+    Drive versions tell which documents to download, removed documents and sections are deleted from the index
+    and the docstore content hash of every section decides what is re-embedded. Returns the updated index with its
+    version directory, or None when the saved one is already up to date. Raises HttpError when a document can't be read.
+
+    Only one process updates an index at a time. While it does, the others return None right away and keep
+    using the current version, unless there is no saved index yet to use.
+    """
+    lock = get_index_lock(index_name)
+    try:
+        lock.acquire(timeout=0 if get_index_path(index_name) else -1)
+    except Timeout:
+        return None
+    try:
+        return update_index(business_unit, document_ids, documents_folder, index_name, file_url, service_context,
+                            resave_documents)
+    finally:
+        lock.release()
+
+
+def update_index(business_unit, document_ids, documents_folder, index_name, file_url, service_context,
+                 resave_documents=False):
+    """Build the next index version in its own directory and publish it. Must be called under the index lock."""
+    docs_service, drive = get_google_services(file_url)
+
+    index_path = get_index_path(index_name)
+    manifest = read_documents_manifest(index_path) if index_path else None
+    # an index saved before documents were tracked one by one is rebuilt from scratch
+    index_exists = manifest is not None
+    manifest = manifest or {}
+    files_metadata = dict(zip(document_ids, fetch_files_metadata(drive, document_ids)))
+    changed_ids = [
+        document_id for document_id in document_ids
+        if resave_documents or manifest.get(document_id) != files_metadata[document_id]['version']
+    ]
+    removed_ids = [document_id for document_id in manifest if document_id not in files_metadata]
+    if index_exists and not changed_ids and not removed_ids:
+        record_documents_list(business_unit, document_ids)
+        return None
+
+    documents = []
+    texts = {}
+    for document_id, doc in zip(changed_ids, fetch_documents(docs_service, changed_ids)):
+        sections = read_section_documents(document_id, doc)
+        documents += sections
+        texts[document_id] = ''.join(section.text for section in sections)
+
+    new_index_path = new_index_version(index_name, index_path if index_exists else None)
+    try:
+        if index_exists:
+            index = load_index_from_storage(get_storage_context(new_index_path), service_context=service_context)
+        else:
+            index = GPTVectorStoreIndex.from_documents([], storage_context=get_storage_context(),
+                                                       service_context=service_context)
+        # sections that are gone, and whole documents indexed before they were split into sections
+        stale_ids = set(changed_ids) | set(removed_ids)
+        section_ids = {document.doc_id for document in documents}
+        deleted = False
+        for ref_doc_id in list(index.ref_doc_info):
+            if ref_doc_id.split('#')[0] in stale_ids and ref_doc_id not in section_ids:
+                index.delete_ref_doc(ref_doc_id, delete_from_docstore=True)
+                deleted = True
+        refreshed = any(index.refresh_ref_docs(documents))
+        new_manifest = {document_id: files_metadata[document_id]['version'] for document_id in document_ids}
+        # a forced resave of unchanged text keeps the published version, and with it the index and response caches
+        if index_exists and not deleted and not refreshed and new_manifest == manifest:
+            shutil.rmtree(new_index_path)
+            record_documents_list(business_unit, document_ids)
+            return None
+        index.storage_context.persist(persist_dir=new_index_path)
+        write_documents_manifest(new_index_path, new_manifest)
+        publish_index_version(index_name, new_index_path)
+        record_documents_list(business_unit, document_ids)
+    except Exception:
+        # an abandoned version newer than the live one would outlive it when old versions are pruned
+        if get_index_path(index_name) != os.path.realpath(new_index_path):
+            shutil.rmtree(new_index_path, ignore_errors=True)
+        raise
+
+    os.makedirs(documents_folder, exist_ok=True)
+    for document_id in removed_ids:
+        if os.path.exists(os.path.join(documents_folder, document_id + '.txt')):
+            os.remove(os.path.join(documents_folder, document_id + '.txt'))
+    for document_id, text in texts.items():
+        with io.open(os.path.join(documents_folder, document_id + '.txt'), 'wb') as f:
+            f.write(text.encode('utf-8'))
+
+    business_unit.last_update_document = max((
+        datetime.datetime.strptime(file_metadata['modifiedTime'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        for file_metadata in files_metadata.values()
+    ), default=None)
+    # the unit may have been loaded long before, a full save would undo the edits and token refreshes since
+    business_unit.save(update_fields=['last_update_document'])
+    return index, new_index_path
+
+
+def make_query(query_text, document_ids, documents_folder, index_name, openai_key, file_url, resave_documents=False,
+               streaming=False):
+    """Answer from the FAQ, the response cache or the LLM over the unit's documents.
+
+    With streaming an LLM answer comes as "response_gen", a generator of text chunks, and "response" is filled in
+    once the generator is exhausted. Answers that are ready at once are returned whole either way.
+    """
+    business_unit = BusinessUnit.objects.filter(apikey=documents_folder.split('documents-')[1]).first()
+
+    closest_answer = find_exact_answer(business_unit.id, query_text) or \
+        find_closest_answer(business_unit.id, query_text, business_unit.similarity_simple_q)
+    if closest_answer:
+        return {"response": closest_answer, "eval_result": 5,
+                "llm_context": 'None'}
+
+    use_openai_key(openai_key)
+    service_context = get_service_context(business_unit)
+
+    synced = None
+    # with the background sync the sync_documents worker keeps the index fresh, forced resaves and document list
+    # changes included, and requests only call Google when there is no index yet
+    if not DOCUMENTS_BACKGROUND_SYNC or not os.path.exists(index_name):
+        try:
+            synced = sync_documents(business_unit, document_ids, documents_folder, index_name, file_url,
+                                    service_context, resave_documents)
+        except HttpError:
+            return {
+                "response": business_unit.panic_text if business_unit.panic_text else "The provided file is not in "
+                                                                                      "the public domain or the "
+                                                                                      "document ID is incorrect.",
+                "eval_result": 5,
+                "llm_context": None
+            }
+
+    if synced is None:
+        index, index_path = get_index(index_name, openai_key, service_context)
     else:
-        documents = SimpleDirectoryReader(documents_folder).load_data()
-        index = GPTVectorStoreIndex.from_documents(
-            documents, service_context=service_context
-        )
-        index.storage_context.persist(persist_dir=index_name)
+        index, index_path = synced
+        cache_index(index_name, openai_key, index, index_path)
 
+    # a cached index may have been loaded with older unit settings, the query uses the current ones
     query_engine = index.as_query_engine(
-        similarity_top_k=business_unit.similarity_top_k if business_unit.similarity_top_k else 1
+        similarity_top_k=business_unit.similarity_top_k if business_unit.similarity_top_k else 1,
+        service_context=service_context,
+        streaming=streaming,
     )
-    response = query_engine.query(query_text)
+    query_embedding = service_context.embed_model.get_query_embedding(query_text)
+    query_bundle = QueryBundle(query_str=query_text, embedding=query_embedding)
+    nodes = query_engine.retrieve(query_bundle)
+
+    # a paraphrase of an already answered question gets the same answer without an LLM call. Questions about
+    # another course or price can embed just as close, so the answer must also come from the same sections.
+    response_version = get_response_version(business_unit, index_path)
+    source_ids = tuple(node.node.node_id for node in nodes)
+    cached_response = get_cached_response(business_unit.id, response_version, query_embedding, source_ids)
+    if cached_response:
+        return dict(cached_response)
+
+    response = query_engine.synthesize(query_bundle, nodes)
 
     context = []
 
@@ -264,8 +597,26 @@ def make_query(query_text, document_ids, documents_folder, index_name, openai_ke
     #     eval_chat_template=eval_chat_template, llm=llm, threshold=4.0
     # )
 
-    return {"response": response.response, "eval_result": 5,
-            "llm_context": context}
+    # without retrieved nodes llama_index answers with a plain "Empty Response" even when streaming
+    if isinstance(response, StreamingResponse):
+        result = {"response": None, "eval_result": 5, "llm_context": context}
+
+        def response_gen():
+            chunks = []
+            for chunk in response.response_gen:
+                chunks.append(chunk)
+                yield chunk
+            result["response"] = ''.join(chunks)
+            cache_response(business_unit.id, response_version, query_embedding, source_ids,
+                           {"response": result["response"], "eval_result": 5, "llm_context": context})
+
+        result["response_gen"] = response_gen()
+        return result
+
+    result = {"response": str(response), "eval_result": 5,
+              "llm_context": context}
+    cache_response(business_unit.id, response_version, query_embedding, source_ids, result)
+    return dict(result)
 
 
 def translate_to_ukrainian(text):
@@ -284,42 +635,177 @@ def translate_to_ukrainian(text):
     #     return text
 
 
+def get_smart_sender_message(contact_id, response):
+    """URL and request body of a SmartSender text message."""
+    return SMART_SENDER_MESSAGE.format(contactId=contact_id), {"data": {
+        "content": response,
+        "type": "text",
+        "watermark": int(time.time())
+    }}
+
+
 def smart_sender_flow(request_type, business_units, contact_id=None, response=None):
     headers = {"Authorization": f"Bearer {business_units.smart_sender_token}"}
 
     if request_type == "send_message":
-        r = requests.post(f'{SMART_SENDER_URL}{SMART_SENDER_MESSAGE.format(contactId=contact_id)}', headers=headers,
-                          data={
-                              "content": response,
-                              "type": "text",
-                              "watermark": int(time.time())
-                          })
+        url, body = get_smart_sender_message(contact_id, response)
+        r = get_http_session(SMART_SENDER_URL).post(f'{SMART_SENDER_URL}{url}', headers=headers, **body)
         return r
     elif request_type == "word_trigger":
-        r = requests.post(f'{SMART_SENDER_URL}{SMART_SENDER_RUN_BY_TRIGGER.format(contactId=contact_id)}',
-                          headers=headers,
-                          data={
-                              "name": business_units.default_text
-                          })
+        r = get_http_session(SMART_SENDER_URL).post(
+            f'{SMART_SENDER_URL}{SMART_SENDER_RUN_BY_TRIGGER.format(contactId=contact_id)}',
+            headers=headers,
+            data={
+                "name": business_units.default_text
+            })
         return r
 
 
-def send_pulse_flow(request_type, business_units, contact_id=None, source_type=None, **kwargs):
-    headers = {"Authorization": f"Bearer {business_units.sendpulse_token}"}
+def get_send_pulse_messages(source_type, contact_id, parts):
+    """URLs and request bodies that send the parts in order. Viber and live chat take up to
+    SEND_PULSE_MAX_MESSAGES_PER_REQUEST parts in one request, telegram one. Empty parts and unknown source types
+    send nothing."""
+    parts = [part for part in parts if part]
+    if source_type == "telegram":
+        return [(SEND_PULSE_TELEGRAM_MESSAGE, {"data": {
+            "contact_id": contact_id,
+            "text": part
+        }}) for part in parts]
 
-    if request_type == "auth":
-        datetime_now = datetime.datetime.now(datetime.timezone.utc)
+    elif source_type in ("viber", "live_chat"):
+        url = SEND_PULSE_VIBER_MESSAGE if source_type == "viber" else SEND_PULSE_LIVE_CHAT_MESSAGE
+        return [(url, {"json": {
+            "contact_id": contact_id,
+            "messages": [
+                {
+                    "type": "text",
+                    "text": {
+                        "text": part
+                    }
+                }
+                for part in parts[start:start + SEND_PULSE_MAX_MESSAGES_PER_REQUEST]
+            ]
+        }}) for start in range(0, len(parts), SEND_PULSE_MAX_MESSAGES_PER_REQUEST)]
+    return []
+
+
+def get_send_pulse_message(source_type, contact_id, part):
+    """URL and request body of a SendPulse text message, None without a part or for an unknown source type."""
+    messages = get_send_pulse_messages(source_type, contact_id, [part])
+    return messages[0] if messages else None
+
+
+def request_send_pulse_token(business_unit):
+    data = {
+        "grant_type": "client_credentials",
+        "client_id": business_unit.sendpulse_id,
+        "client_secret": business_unit.sendpulse_secret
+    }
+    issued_at = datetime.datetime.now(datetime.timezone.utc)
+    r = get_http_session(SEND_PULSE_URL).post(f'{SEND_PULSE_URL}{SEND_PULSE_AUTH}', data=data)
+    token = r.json().get('access_token') if r.ok else None
+    if not token:
+        raise ValueError(f"SendPulse didn't issue a token for {business_unit.sendpulse_id}: {r.status_code} {r.text}")
+
+    with _send_pulse_tokens_lock:
+        _send_pulse_tokens[business_unit.sendpulse_id] = (token, issued_at)
+    business_unit.sendpulse_token = token
+    business_unit.last_update_sendpulse = issued_at
+    business_unit.save(update_fields=['sendpulse_token', 'last_update_sendpulse'])
+    return token
+
+
+def _run_send_pulse_refresh(business_unit, refresh):
+    """Request the token for the refresh registered in _send_pulse_refreshes and hand it to the waiting callers."""
+    try:
+        token = request_send_pulse_token(business_unit)
+        refresh.set_result(token)
+        return token
+    except Exception as e:
+        refresh.set_exception(e)
+        raise
+    finally:
+        with _send_pulse_tokens_lock:
+            del _send_pulse_refreshes[business_unit.sendpulse_id]
 
-        data = {
-            "grant_type": "client_credentials",
-            "client_id": business_units.sendpulse_id,
-            "client_secret": business_units.sendpulse_secret
-        }
-        sendpulse_auth = json.loads(requests.post(f'{SEND_PULSE_URL}{SEND_PULSE_AUTH}', data=data).text)
 
-        business_units.sendpulse_token = sendpulse_auth.get('access_token', None)
-        business_units.last_update_sendpulse = datetime_now
-        business_units.save()
+def refresh_send_pulse_token(business_unit, stale_token=None):
+    """Get a new token. Only one request per sendpulse_id is in flight, concurrent callers wait for its result.
+
+    With stale_token, a token that another thread got since stale_token was read is returned as is.
+    """
+    key = business_unit.sendpulse_id
+    with _send_pulse_tokens_lock:
+        refresh = _send_pulse_refreshes.get(key)
+        if refresh is None:
+            cached = _send_pulse_tokens.get(key)
+            if stale_token is not None and cached and cached[0] != stale_token:
+                business_unit.sendpulse_token = cached[0]
+                return cached[0]
+            refresh = _send_pulse_refreshes[key] = Future()
+            refreshing = True
+        else:
+            refreshing = False
+    if not refreshing:
+        business_unit.sendpulse_token = refresh.result()
+        return business_unit.sendpulse_token
+    return _run_send_pulse_refresh(business_unit, refresh)
+
+
+def _refresh_send_pulse_token_in_background(business_unit, refresh):
+    from django.db import connection
+
+    try:
+        _run_send_pulse_refresh(business_unit, refresh)
+    except Exception as e:
+        print(f"SENDPULSE TOKEN REFRESH FAILED: {e}")
+    finally:
+        connection.close()
+
+
+def get_send_pulse_token(business_unit):
+    """Access token of the unit from memory. A token near its end is renewed in the background, an expired or
+    missing one is requested while the caller waits."""
+    key = business_unit.sendpulse_id
+    cached = _send_pulse_tokens.get(key)
+    # another worker may have saved a newer token
+    if business_unit.sendpulse_token and business_unit.last_update_sendpulse and \
+            (cached is None or cached[1] < business_unit.last_update_sendpulse):
+        cached = (business_unit.sendpulse_token, business_unit.last_update_sendpulse)
+        with _send_pulse_tokens_lock:
+            _send_pulse_tokens[key] = cached
+
+    age = None if cached is None else (datetime.datetime.now(datetime.timezone.utc) - cached[1]).total_seconds()
+    if age is None or age > SEND_PULSE_TOKEN_TTL:
+        return refresh_send_pulse_token(business_unit, stale_token=cached and cached[0])
+    if age > SEND_PULSE_TOKEN_TTL - SEND_PULSE_TOKEN_REFRESH_AHEAD:
+        # registered before the thread starts, so a burst of requests starts one refresh
+        with _send_pulse_tokens_lock:
+            refresh = None
+            if key not in _send_pulse_refreshes:
+                refresh = _send_pulse_refreshes[key] = Future()
+        if refresh is not None:
+            # a copy, the request keeps using its own instance
+            threading.Thread(target=_refresh_send_pulse_token_in_background,
+                             args=(copy.copy(business_unit), refresh), daemon=True).start()
+    business_unit.sendpulse_token = cached[0]
+    return cached[0]
+
+
+def post_to_send_pulse(business_unit, url, **kwargs):
+    """POST with the access token of the unit. A rejected token is renewed and the request is sent once more."""
+    session = get_http_session(SEND_PULSE_URL)
+    token = get_send_pulse_token(business_unit)
+    r = session.post(f'{SEND_PULSE_URL}{url}', headers={"Authorization": f"Bearer {token}"}, **kwargs)
+    if r.status_code == UNAUTHORIZED:
+        token = refresh_send_pulse_token(business_unit, stale_token=token)
+        r = session.post(f'{SEND_PULSE_URL}{url}', headers={"Authorization": f"Bearer {token}"}, **kwargs)
+    return r
+
+
+def send_pulse_flow(request_type, business_units, contact_id=None, source_type=None, **kwargs):
+    if request_type == "auth":
+        get_send_pulse_token(business_units)
         return OK
 
     elif request_type == "word_trigger":
@@ -334,56 +820,26 @@ def send_pulse_flow(request_type, business_units, contact_id=None, source_type=N
             "trigger_keyword": business_units.default_text,
         }
 
-        r = requests.post(
-            f"{SEND_PULSE_URL}{send_pulse_url}", headers=headers, data=request_data
-        )
+        r = post_to_send_pulse(business_units, send_pulse_url, data=request_data)
 
         return r
 
     elif request_type == "send_message":
-        part = kwargs.get("part", None)
-
-        if part and source_type == "telegram":
-            r = requests.post(f'{SEND_PULSE_URL}{SEND_PULSE_TELEGRAM_MESSAGE}', headers=headers, data={
-                "contact_id": contact_id,
-                "text": part
-            })
+        message = get_send_pulse_message(source_type, contact_id, kwargs.get("part", None))
+        if message:
+            url, body = message
+            r = post_to_send_pulse(business_units, url, **body)
             return r
 
-        elif part and source_type == "viber":
-            r = requests.post(f'{SEND_PULSE_URL}{SEND_PULSE_VIBER_MESSAGE}', headers=headers, json={
-                "contact_id": contact_id,
-                "messages": [
-                    {
-                        "type": "text",
-                        "text": {
-                            "text": part
-                        }
-                    }
-                ]
-            })
-            return r
-
-        elif part and source_type == "live_chat":
-            r = requests.post(f'{SEND_PULSE_URL}{SEND_PULSE_LIVE_CHAT_MESSAGE}', headers=headers, json={
-                "contact_id": contact_id,
-                "messages": [
-                    {
-                        "type": "text",
-                        "text": {
-                            "text": part
-                        }
-                    }
-                ]
-            })
-            return r
+    elif request_type == "send_messages":
+        # one after the other, the parts must arrive in order
+        return [post_to_send_pulse(business_units, url, **body)
+                for url, body in get_send_pulse_messages(source_type, contact_id, kwargs.get("parts", []))]
 
 
 def gpt_assistant_query(query_text, business_unit, openai_key):
-    openai.api_key = openai_key
-    os.environ["OPENAI_API_KEY"] = openai.api_key
-
-    client = openai.OpenAI()
+    # the key is passed to the client, answers of different units run side by side in the same process
+    client = openai.OpenAI(api_key=openai_key, http_client=get_openai_http_client())
     thread = client.beta.threads.create()
 
     message = client.beta.threads.messages.create(
@@ -437,3 +893,46 @@ def split_text_into_parts(text, max_length=512):
         text = text[split_index:].strip()
 
     return final_parts
+
+
+def find_part_end(text, min_length, max_length):
+    """End of the next part of a text that is still being written, None while the part may still grow."""
+    end = None
+    for match in SENTENCE_END_RE.finditer(text):
+        if match.end() > max_length:
+            break
+        if NOT_SENTENCE_END_RE.fullmatch(text[:match.end()].rsplit(None, 1)[-1]):
+            continue
+        end = match.end()
+        if end >= min_length:
+            return end
+    if len(text) <= max_length:
+        return None
+    # no sentence fits: the same fallbacks as split_text_into_parts
+    if end:
+        return end
+    split_index = text[:max_length].rfind(' ') + 1
+    return split_index if split_index > 0 else max_length
+
+
+def iter_text_parts(chunks, max_length=512, min_length=LLM_STREAM_MIN_PART_LENGTH,
+                    min_first_length=LLM_STREAM_MIN_FIRST_PART_LENGTH):
+    """split_text_into_parts for streamed text, yielding every part as soon as its last sentence is complete.
+
+    The first part gathers sentences up to min_first_length characters, so it can be sent while the rest is
+    generated, later parts up to min_length characters.
+    """
+    text = ''
+    first_part = True
+    for chunk in chunks:
+        text += chunk
+        while True:
+            split_index = find_part_end(text, min_first_length if first_part else min_length, max_length)
+            if split_index is None:
+                break
+            part, text = text[:split_index].strip(), text[split_index:].lstrip()
+            if part:
+                first_part = False
+                yield part
+    if text.strip():
+        yield from split_text_into_parts(text.strip(), max_length)